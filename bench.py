@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Benchmarks for the compressors and decompressors in this repo.
+
+Runs every codec over a synthetic corpus and reports throughput (MB/s of
+uncompressed data), peak memory and compression ratio as JSON:
+
+    python3 bench.py --sizes 65536,1048576 > baseline.json
+    python3 bench.py --compare baseline.json
+
+With --compare, results that got slower, bigger or hungrier than the
+baseline by more than --threshold are listed and the exit status is 1.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import armdecomp3
+import compress
+import lzss3
+import verify
+
+KINDS = ('random', 'text', 'sparse', 'tiles', 'runs')
+
+WORDS = (b'the of and to in is that for it as was with be by on not he this '
+         b'are or his from at which but have an they you were her she there '
+         b'all one word their we been has would when if more will no out so '
+         b'tile map sprite palette overlay arm9 header offset size data').split()
+
+def make_corpus(kind, size, seed=0):
+    """Generates size bytes of synthetic data of the given kind."""
+    rng = random.Random(seed)
+    if kind == 'random':
+        return rng.randbytes(size)
+
+    buf = bytearray()
+    if kind == 'text':
+        while len(buf) < size:
+            buf += rng.choice(WORDS)
+            buf += b'\n' if rng.random() < 0.05 else b' '
+    elif kind == 'sparse':
+        # mostly zeros, like save templates and padded tables
+        buf = bytearray(size)
+        for _ in range(size // 64):
+            buf[rng.randrange(size)] = rng.randrange(1, 256)
+    elif kind == 'tiles':
+        # 8x8 4bpp tiles drawn from a small set, some of them flipped
+        tiles = [bytes(rng.choice(b'\x00\x11\x12\x21\x22\x33') for _ in range(32))
+                 for _ in range(48)]
+        while len(buf) < size:
+            tile = rng.choice(tiles)
+            buf += tile if rng.random() < 0.8 else tile[::-1]
+    elif kind == 'runs':
+        while len(buf) < size:
+            buf += bytes([rng.randrange(256)]) * rng.randrange(1, 2000)
+    else:
+        raise ValueError("unknown corpus kind: {}".format(kind))
+
+    return bytes(buf[:size])
+
+def _lz10_overlay_stream(data):
+    """LZ10 with overlay displacements, forwards, as armdecomp3 reads it."""
+    out = bytearray()
+    compress._emit_nlz10(compress._tokenize(data, compress.NOverlayWindow), out, disp_extra=3)
+    return bytes(out)
+
+def _compress_with(func, *args):
+    def run(data):
+        out = BytesIO()
+        func(data, out, *args)
+        return out.getvalue()
+    return run
+
+def _stream_compress(format):
+    def run(data):
+        c = compress.LZCompressor(format, len(data))
+        chunks = [c.compress(data[i:i+0x10000]) for i in range(0, len(data), 0x10000)]
+        chunks.append(c.flush())
+        return b''.join(chunks)
+    return run
+
+def _stream_decompress(data, size):
+    d = lzss3.LZDecompressor()
+    return b''.join(d.decompress(data[i:i+0x10000]) for i in range(0, len(data), 0x10000))
+
+def _overlay_compress(data):
+    out = BytesIO()
+    if not compress.compress_overlay(data, out):
+        # stored as is; nothing to decompress
+        return None
+    return out.getvalue()
+
+def _overlay_decompress(data, size):
+    out = BytesIO()
+    lzss3.decompress_overlay(BytesIO(data), out)
+    return out.getvalue()
+
+# name: compress function
+ENCODERS = {
+    'compress.lz10': _compress_with(compress.compress),
+    'compress.lz11': _compress_with(compress.compress_nlz11),
+    'compress.lz11-tree': _compress_with(compress.compress_nlz11, compress.NLZ11TreeWindow),
+    'compress.overlay': _compress_with(compress.compress_overlay),
+    'compress.stream-lz10': _stream_compress(0x10),
+    'compress.stream-lz11': _stream_compress(0x11),
+}
+
+# name: (prepare, decompress). prepare compresses the input into whatever
+# decompress(data, size) takes, or returns None to skip it, and only
+# decompress is timed.
+DECODERS = {
+    'lzss3.lz10': (_compress_with(compress.compress),
+                   lambda data, size: lzss3.decompress_bytes(data)),
+    'lzss3.lz11': (_compress_with(compress.compress_nlz11),
+                   lambda data, size: lzss3.decompress_bytes(data)),
+    'lzss3.overlay': (_overlay_compress, _overlay_decompress),
+    'lzss3.stream-lz11': (_compress_with(compress.compress_nlz11), _stream_decompress),
+    'verify.lz10': (_compress_with(compress.compress),
+                    lambda data, size: verify.decompress_raw_lzss10(data[4:], size)),
+    'armdecomp3.lz10': (_lz10_overlay_stream, armdecomp3.decompress),
+}
+
+def _time(func, args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def _peak(func, args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(kinds=KINDS, sizes=(0x10000,), codecs=None, repeat=3, seed=0):
+    """Runs the benchmarks and returns the results as a dict, ready for
+    json.dump().
+
+    Decoders that fail on an input are listed under 'skipped' instead.
+    Some of the older ones can't cope with every size."""
+    results = []
+    skipped = []
+    for kind in kinds:
+        for size in sizes:
+            data = make_corpus(kind, size, seed)
+            for name, func in ENCODERS.items():
+                if codecs and name not in codecs:
+                    continue
+                elapsed, compressed = _time(func, (data,), repeat)
+                results.append(_result(name, kind, size, elapsed, _peak(func, (data,)),
+                                       len(compressed) / size))
+
+            for name, (prepare, func) in DECODERS.items():
+                if codecs and name not in codecs:
+                    continue
+                compressed = prepare(data)
+                if compressed is None:
+                    continue
+                try:
+                    elapsed, decompressed = _time(func, (compressed, size), repeat)
+                except Exception as e:
+                    skipped.append({'codec': name, 'corpus': kind, 'size': size,
+                                    'error': repr(e)})
+                    continue
+                if decompressed != data:
+                    raise AssertionError("{} doesn't round-trip {} data".format(name, kind))
+                results.append(_result(name, kind, size, elapsed,
+                                       _peak(func, (compressed, size)),
+                                       len(compressed) / size))
+
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+        'skipped': skipped,
+    }
+
+def _result(name, kind, size, elapsed, peak, ratio):
+    return {
+        'codec': name,
+        'corpus': kind,
+        'size': size,
+        'seconds': round(elapsed, 6),
+        'mb_per_s': round(size / 1e6 / elapsed, 3) if elapsed else None,
+        'peak_bytes': peak,
+        'ratio': round(ratio, 5),
+    }
+
+def compare(baseline, current, threshold=0.1):
+    """Returns a list of messages for each result in current that is worse
+    than the same codec, corpus and size in baseline by more than
+    threshold (a fraction)."""
+    old = {(r['codec'], r['corpus'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        key = (r['codec'], r['corpus'], r['size'])
+        if key not in old:
+            continue
+        b = old[key]
+        label = "{0} on {2} bytes of {1}".format(*key)
+        if b['mb_per_s'] and r['mb_per_s'] and r['mb_per_s'] < b['mb_per_s'] * (1 - threshold):
+            regressions.append("{}: {:.3f} MB/s, was {:.3f}".format(label, r['mb_per_s'], b['mb_per_s']))
+        if b['peak_bytes'] * (1 + threshold) < r['peak_bytes']:
+            regressions.append("{}: peak {} bytes, was {}".format(label, r['peak_bytes'], b['peak_bytes']))
+        if b['ratio'] < r['ratio'] - 1e-9:
+            regressions.append("{}: ratio {:.5f}, was {:.5f}".format(label, r['ratio'], b['ratio']))
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the LZ codecs.")
+    parser.add_argument('--kinds', default=','.join(KINDS),
+                        help="comma-separated corpus kinds (default: all)")
+    parser.add_argument('--sizes', default='65536',
+                        help="comma-separated corpus sizes in bytes, up to 16777215")
+    parser.add_argument('--codecs', default='',
+                        help="comma-separated codecs to run (default: all)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="take the best time of this many runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="compare against results saved from an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed slowdown or memory growth, as a fraction")
+    parser.add_argument('--list', action='store_true', help="list the codecs")
+    args = parser.parse_args(args)
+
+    if args.list:
+        for name in list(ENCODERS) + list(DECODERS):
+            print(name)
+        return 0
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    if any(not 0 < s <= 0xFFFFFF for s in sizes):
+        parser.error("sizes must be between 1 and 16777215")
+    codecs = [c for c in args.codecs.split(',') if c]
+    unknown = set(codecs) - set(ENCODERS) - set(DECODERS)
+    if unknown:
+        parser.error("unknown codecs: {}".format(', '.join(sorted(unknown))))
+
+    results = run(args.kinds.split(','), sizes, codecs, args.repeat, args.seed)
+    json.dump(results, sys.stdout, indent=1)
+    print()
+    for r in results['skipped']:
+        print("{codec} failed on {size} bytes of {corpus}: {error}".format(**r),
+              file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for message in regressions:
+            print(message, file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,44 @@
 # used http://code.google.com/p/u-lzss/source/browse/trunk/js/lib/ulzss.js as
 # a guide
+import hashlib
+import os
+import sys
+import time
+from io import BytesIO
 from sys import stderr
 
-from collections import defaultdict
-from operator import itemgetter
+from array import array
+from bisect import bisect_left
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from struct import pack, unpack
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _match_length(data, a, b, n):
+    """Returns the length of the common prefix of data[a:] and data[b:], up to
+    n bytes."""
+    # Compare slices of doubling size, so that short matches stay cheap and
+    # long ones are compared at memcmp speed. In the first block that
+    # differs, the lowest set bit of the two blocks xored together (as
+    # little-endian ints) is the first mismatching byte.
+    from_bytes = int.from_bytes
+    i = 0
+    step = 16
+    while i < n:
+        j = min(i + step, n)
+        x = data[a+i:a+j]
+        y = data[b+i:b+j]
+        if x != y:
+            d = from_bytes(x, 'little') ^ from_bytes(y, 'little')
+            return i + (((d & -d).bit_length() - 1) >> 3)
+        i = j
+        step <<= 1
+    return n
+
 class SlidingWindow:
     # The size of the sliding window
     size = 4096
@@ -17,71 +50,106 @@ class SlidingWindow:
     # compressed stream.
     disp_start = 1
 
-    # The minimum length for a successful match in the window
-    match_min = 1
+    # The minimum length for a successful match in the window. The hash
+    # chains are keyed on a 3-byte prefix, so this can't be any lower.
+    match_min = 3
 
     # The maximum length of a successful match, inclusive.
     match_max = None
 
+    # Number of bits in the hash of a 3-byte prefix.
+    hash_bits = 15
+
     def __init__(self, buf):
         self.data = buf
-        self.hash = defaultdict(list)
-        self.full = False
-
-        self.start = 0
-        self.stop = 0
-        #self.index = self.disp_min - 1
         self.index = 0
 
+        # head[h] is the most recent position whose prefix hashes to h, and
+        # prev[p % size] is the position before p with the same hash. Both
+        # hold -1 for "no position". Positions that have slid out of the
+        # window are never followed, so nothing has to be evicted.
+        self.head = array('l', [-1]) * (1 << self.hash_bits)
+        self.prev = array('l', [-1]) * self.size
+
+        # How many earlier positions search() has looked at, for MatchStats.
+        self.candidates = 0
+
         assert self.match_max is not None
+        assert 3 <= self.match_min
+
+    def hash(self, i):
+        data = self.data
+        key = (data[i] << 16) | (data[i+1] << 8) | data[i+2]
+        return ((key * 2654435761) & 0xFFFFFFFF) >> (32 - self.hash_bits)
 
     def next(self):
         if self.index < self.disp_start - 1:
             self.index += 1
             return
 
-        if self.full:
-            olditem = self.data[self.start]
-            assert self.hash[olditem][0] == self.start
-            self.hash[olditem].pop(0)
-
-        item = self.data[self.stop]
-        self.hash[item].append(self.stop)
-        self.stop += 1
+        i = self.index
+        if i + 3 <= len(self.data):
+            h = self.hash(i)
+            self.prev[i % self.size] = self.head[h]
+            self.head[h] = i
         self.index += 1
 
-        if self.full:
-            self.start += 1
-        else:
-            if self.size <= self.stop:
-                self.full = True
-
     def advance(self, n=1):
         """Advance the window by n bytes"""
         for _ in range(n):
             self.next()
 
+    def discard(self, n):
+        """Drop the first n bytes of data, which must be behind the window.
+
+        n has to be a multiple of the window size, so that positions keep
+        their slots in the tables."""
+        assert n % self.size == 0 and n <= self.index - self.size
+        del self.data[:n]
+        self.index -= n
+        self.head = array('l', [i - n for i in self.head])
+        self.prev = array('l', [i - n for i in self.prev])
+
     def search(self):
+        index = self.index
+        if len(self.data) - index < self.match_min:
+            return None
+
+        return self.search_chain(self.head[self.hash(index)])
+
+    def search_chain(self, i):
+        """Finds the longest match in the hash chain starting at position i."""
+        index = self.index
         match_max = self.match_max
-        match_min = self.match_min
-
-        counts = []
-        indices = self.hash[self.data[self.index]]
-        for i in indices:
-            matchlen = self.match(i, self.index)
-            if matchlen >= match_min:
-                disp = self.index - i
-                #assert self.index - disp >= 0
-                #assert self.disp_min <= disp < self.size + self.disp_min
-                if self.disp_min <= disp:
-                    counts.append((matchlen, -disp))
-                    if matchlen >= match_max:
-                        #assert matchlen == match_max
-                        return counts[-1]
-
-        if counts:
-            match = max(counts, key=itemgetter(0))
-            return match
+        disp_min = self.disp_min
+        size = self.size
+        prev = self.prev
+        limit = max(index - size, 0)
+
+        # Walk the chain from the most recent candidate back; on a tie the
+        # nearest match wins.
+        data = self.data
+        end = min(len(data) - index, match_max)
+        best = 0
+        bestdisp = 0
+        visited = 0
+        while limit <= i:
+            visited += 1
+            disp = index - i
+            # A candidate can only beat the best match so far if it agrees
+            # with the lookahead on the byte just past it.
+            if disp_min <= disp and data[i + best] == data[index + best]:
+                matchlen = self.match(i, index)
+                if best < matchlen:
+                    best = matchlen
+                    bestdisp = disp
+                    if matchlen >= end:
+                        break
+            i = prev[i % size]
+        self.candidates += visited
+
+        if best >= self.match_min:
+            return (best, -bestdisp)
 
         return None
 
@@ -91,14 +159,17 @@ class SlidingWindow:
         if size == 0:
             return 0
 
-        matchlen = 0
-        it = range(min(len(self.data) - bufstart, self.match_max))
-        for i in it:
-            if self.data[start + (i % size)] == self.data[bufstart + i]:
-                matchlen += 1
-            else:
-                break
-        return matchlen
+        n = min(len(self.data) - bufstart, self.match_max)
+        if n <= size:
+            return _match_length(self.data, start, bufstart, n)
+
+        # The match runs into the lookahead, repeating data[start:bufstart].
+        # Once one whole period matches, the rest of the match is just the
+        # lookahead compared against itself one period later.
+        matchlen = _match_length(self.data, start, bufstart, size)
+        if matchlen < size:
+            return matchlen
+        return size + _match_length(self.data, bufstart, bufstart + size, n - size)
 
 class NLZ10Window(SlidingWindow):
     size = 4096
@@ -115,125 +186,1104 @@ class NLZ11Window(SlidingWindow):
 class NOverlayWindow(NLZ10Window):
     disp_min = 3
 
-def _compress(input, windowclass=NLZ10Window):
-    """Generates a stream of tokens. Either a byte (int) or a tuple of (count,
-    displacement)."""
+class BinaryTreeWindow(SlidingWindow):
+    """A match finder which keeps the window in binary search trees, one per
+    hash bucket, like the BT finders in LZMA.
 
-    window = windowclass(input)
+    Each node is a position, ordered by the bytes following it. The root of
+    each tree is the most recent position, and the longest match is always
+    on the path that a new position takes down the tree, so a search only
+    visits O(log n) candidates.
 
-    i = 0
-    while True:
-        if len(input) <= i:
-            break
+    Positions are compared up to nice_len bytes. A match that long is then
+    extended directly up to match_max, so for very long matches this may
+    not find the longest of several equally good candidates.
+
+    Positions starting with a run of one byte would sort in order of
+    position and turn the tree into a long list, so they go on a plain
+    hash chain per byte value instead.
+
+    Every position costs a walk down a tree to insert, where the hash
+    chains only walk at the start of each token, so in Python this is
+    slower than SlidingWindow on most data.
+
+    Mix this in ahead of a window class to pick up its parameters.
+    """
+
+    # The longest match resolved by the tree itself.
+    nice_len = 0x111
+
+    def __init__(self, buf):
+        SlidingWindow.__init__(self, buf)
+        self.nice_len = min(self.nice_len, self.match_max)
+
+        # son[2 * (p % size)] and son[2 * (p % size) + 1] are the positions
+        # of the smaller and larger children of p.
+        self.son = array('l', [-1]) * (2 * self.size)
+
+        # runs[b] is the most recent position starting with b, b, b; the
+        # chain goes on through prev.
+        self.runs = array('l', [-1]) * 256
+
+    def next(self):
+        # Positions enter the tree disp_min - 1 bytes late, so that every
+        # node is a usable candidate once search() gets to it.
+        p = self.index + 1 - self.disp_min
+        if 0 <= p and p + 3 <= len(self.data):
+            data = self.data
+            b = data[p]
+            if b == data[p+1] == data[p+2]:
+                self.prev[p % self.size] = self.runs[b]
+                self.runs[b] = p
+            else:
+                self.insert(p)
+        self.index += 1
+
+    def discard(self, n):
+        SlidingWindow.discard(self, n)
+        self.son = array('l', [i - n for i in self.son])
+        self.runs = array('l', [i - n for i in self.runs])
+
+    def insert(self, pos):
+        data = self.data
+        size = self.size
+        son = self.son
+        lenlimit = min(len(data) - pos, self.nice_len)
+        limit = pos - size
+
+        h = self.hash(pos)
+        cur = self.head[h]
+        self.head[h] = pos
+
+        # ptr1 is the slot waiting for the next node smaller than pos, and
+        # ptr0 the slot waiting for the next larger one.
+        ptr1 = 2 * (pos % size)
+        ptr0 = ptr1 + 1
+        len0 = len1 = 0
+        while 0 <= cur and limit < cur:
+            pair = 2 * (cur % size)
+            n = min(len0, len1)
+            # most candidates differ on the first byte not known to match,
+            # which settles the direction without comparing any further
+            if data[cur + n] == data[pos + n]:
+                n += _match_length(data, cur + n, pos + n, lenlimit - n)
+            if n == lenlimit:
+                # cur is as good as pos; pos takes its place in the tree.
+                son[ptr1] = son[pair]
+                son[ptr0] = son[pair + 1]
+                return
+            if data[cur + n] < data[pos + n]:
+                son[ptr1] = cur
+                ptr1 = pair + 1
+                cur = son[ptr1]
+                len1 = n
+            else:
+                son[ptr0] = cur
+                ptr0 = pair
+                cur = son[ptr0]
+                len0 = n
+        son[ptr0] = son[ptr1] = -1
+
+    def search(self):
+        index = self.index
+        data = self.data
+        if len(data) - index < self.match_min:
+            return None
+
+        # Only another run can match a run for three bytes.
+        b = data[index]
+        if b == data[index+1] == data[index+2]:
+            return self.search_chain(self.runs[b])
+
+        size = self.size
+        son = self.son
+        lenlimit = min(len(data) - index, self.nice_len)
+        limit = max(index - size, 0)
+
+        best = 0
+        bestdisp = 0
+        len0 = len1 = 0
+        visited = 0
+        cur = self.head[self.hash(index)]
+        while limit <= cur:
+            visited += 1
+            n = min(len0, len1)
+            if data[cur + n] == data[index + n]:
+                n += _match_length(data, cur + n, index + n, lenlimit - n)
+            if best < n:
+                best = n
+                bestdisp = index - cur
+                if n == lenlimit:
+                    break
+            if data[cur + n] < data[index + n]:
+                cur = son[2 * (cur % size) + 1]
+                len1 = n
+            else:
+                cur = son[2 * (cur % size)]
+                len0 = n
+        self.candidates += visited
+
+        if best == self.nice_len:
+            best = self.match(index - bestdisp, index)
+
+        if best >= self.match_min:
+            return (best, -bestdisp)
+
+        return None
+
+class NLZ11TreeWindow(BinaryTreeWindow, NLZ11Window):
+    pass
+
+def _prefix_index(data):
+    """Sorts the positions of data by the 3 bytes starting there, keeping
+    equal prefixes in order of position.
+
+    Returns (order, rank, first): order is the sorted positions, order[rank[p]]
+    is p, and order[first[r]] is the first position with the same prefix as
+    order[r]. Uses NumPy if it's installed."""
+    n = max(len(data) - 2, 0)
+    if numpy is not None and n:
+        a = numpy.frombuffer(bytes(data), dtype=numpy.uint8).astype(numpy.uint32)
+        keys = (a[:-2] << 16) | (a[1:-1] << 8) | a[2:]
+        order = numpy.argsort(keys, kind='stable').astype(numpy.int32)
+        sorted_keys = keys[order]
+        starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], sorted_keys[1:] != sorted_keys[:-1])))
+        first = numpy.repeat(starts, numpy.diff(numpy.append(starts, n)))
+        rank = numpy.empty(n, dtype=numpy.int32)
+        rank[order] = numpy.arange(n, dtype=numpy.int32)
+        return tuple(array('i', x.astype(numpy.int32).tobytes())
+                     for x in (order, rank, first))
+
+    keys = [(a << 16) | (b << 8) | c for a, b, c in zip(data, data[1:], data[2:])]
+    order = array('i', sorted(range(n), key=keys.__getitem__))
+    rank = array('i', [0]) * n
+    first = array('i', [0]) * n
+    start = 0
+    key = -1
+    for r, p in enumerate(order):
+        if keys[p] != key:
+            key = keys[p]
+            start = r
+        first[r] = start
+        rank[p] = r
+    return order, rank, first
+
+class PrefixIndexWindow(SlidingWindow):
+    """A match finder which indexes every position of the input by its
+    3-byte prefix before parsing starts, instead of hashing positions one
+    at a time as the window moves. The candidates for a position are then a
+    slice of the index, so next() and advance() only move the index.
+
+    Finds the same matches as the hash chains, but needs the whole input
+    up front and about 12 bytes per input byte, so it only works with the
+    one-shot compress functions, not LZCompressor.
+
+    Mix this in ahead of a window class to pick up its parameters.
+    """
+
+    def __init__(self, buf):
+        SlidingWindow.__init__(self, buf)
+        self.order, self.rank, self.first = _prefix_index(buf)
+
+    def next(self):
+        self.index += 1
+
+    def advance(self, n=1):
+        self.index += n
+
+    def discard(self, n):
+        raise TypeError("{} needs the whole input at once".format(type(self).__name__))
+
+    def search(self):
+        index = self.index
+        data = self.data
+        if len(data) - index < self.match_min:
+            return None
+
+        # Earlier positions with the same prefix are just before this one in
+        # the index, in order of position.
+        order = self.order
+        r = self.rank[index]
+        lo = bisect_left(order, max(index - self.size, 0), self.first[r], r)
+        candidates = order[lo:r]
+        self.candidates += len(candidates)
+
+        disp_min = self.disp_min
+        end = min(len(data) - index, self.match_max)
+        best = 0
+        bestdisp = 0
+        # newest first, so that the nearest match wins a tie
+        for i in reversed(candidates):
+            disp = index - i
+            if disp_min <= disp and data[i + best] == data[index + best]:
+                matchlen = self.match(i, index)
+                if best < matchlen:
+                    best = matchlen
+                    bestdisp = disp
+                    if matchlen >= end:
+                        break
+
+        if best >= self.match_min:
+            return (best, -bestdisp)
+
+        return None
+
+class NLZ10IndexWindow(PrefixIndexWindow, NLZ10Window):
+    pass
+
+class NLZ11IndexWindow(PrefixIndexWindow, NLZ11Window):
+    pass
+
+class MatchStats:
+    """What the match finder did during a compression.
+
+    Pass one as stats= to compress(), compress_nlz11() or compress_overlay()
+    and look at it afterwards; str() gives a summary. Nothing is counted
+    without one, so the compressor runs at full speed.
+
+    compared counts the bytes looked at by the window's match() method,
+    including the mismatch that ends each match. BinaryTreeWindow compares
+    most candidates in the tree itself, so there it only covers the
+    extension of very long matches.
+    """
+
+    def __init__(self):
+        # searches, and the earlier positions they looked at
+        self.positions = 0
+        self.candidates = 0
+        self.compared = 0
+        self.literals = 0
+        # {count: matches} and {displacement: matches}
+        self.lengths = Counter()
+        self.displacements = Counter()
+        # seconds spent finding matches and updating the window, and
+        # seconds spent packing and writing the tokens
+        self.search_time = 0.0
+        self.emit_time = 0.0
+
+    @property
+    def matches(self):
+        return sum(self.lengths.values())
+
+    def __str__(self):
+        matches = self.matches
+        tokens = self.literals + matches
+        lines = [
+            "positions searched:   {}".format(self.positions),
+            "candidates examined:  {} ({:.2f} per position)".format(
+                self.candidates, self.candidates / (self.positions or 1)),
+            "bytes compared:       {}".format(self.compared),
+            "literals:             {} ({:.1%} of tokens)".format(
+                self.literals, self.literals / (tokens or 1)),
+            "matches:              {} ({:.1%} of tokens)".format(
+                matches, matches / (tokens or 1)),
+            "search time:          {:.3f}s".format(self.search_time),
+            "emit time:            {:.3f}s".format(self.emit_time),
+        ]
+        for name, counts in (("match lengths", self.lengths),
+                             ("displacements", self.displacements)):
+            lines.append(name + ":")
+            lines.extend("  {:>5}-{:<5} {}".format(low, high, n)
+                         for low, high, n in _histogram(counts))
+        return "\n".join(lines)
+
+def _histogram(counts):
+    """Buckets a Counter of positive ints by powers of two. Yields (low,
+    high, total) for each non-empty bucket."""
+    buckets = Counter()
+    for value, n in counts.items():
+        buckets[value.bit_length()] += n
+    for bits in sorted(buckets):
+        yield (1 << (bits - 1), (1 << bits) - 1, buckets[bits])
+
+class Tokens:
+    """A stream of LZ tokens, kept in two parallel arrays rather than as an
+    int or a tuple per token.
+
+    counts[k] is 0 if token k is a literal, and values[k] is its byte.
+    Otherwise token k copies counts[k] bytes from values[k] bytes back.
+    """
+
+    def __init__(self):
+        self.counts = array('I')
+        self.values = array('H')
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        """Yields the tokens as _compress() does: a byte (int) or a tuple of
+        (count, -displacement)."""
+        for count, value in zip(self.counts, self.values):
+            if count:
+                yield (count, -value)
+            else:
+                yield value
+
+    def clear(self):
+        del self.counts[:]
+        del self.values[:]
+
+    def truncate(self, n):
+        """Keeps only the first n tokens."""
+        del self.counts[n:]
+        del self.values[n:]
+
+    def take(self, n):
+        """Removes the first n tokens and returns them as a new Tokens."""
+        head = Tokens()
+        head.counts = self.counts[:n]
+        head.values = self.values[:n]
+        del self.counts[:n]
+        del self.values[:n]
+        return head
+
+    def decompressed_size(self):
+        counts = self.counts
+        return sum(counts) + counts.count(0)
+
+def _tokenize(input, windowclass=NLZ10Window, stats=None):
+    """Finds the matches in input. Returns a Tokens.
+
+    If stats is a MatchStats, the work done is added to it."""
+
+    if stats is not None:
+        return _tokenize_counted(input, windowclass, stats)
+
+    return _find_matches(windowclass(input))
+
+def _find_matches(window, stop=None, tokens=None, until=()):
+    """Parses the window's data greedily from its index up to stop (by
+    default, the end), or until landing on one of the positions in until.
+    The last token may run past stop. Appends to tokens, if given, and
+    returns them."""
+    input = window.data
+    if tokens is None:
+        tokens = Tokens()
+    counts = tokens.counts
+    values = tokens.values
+
+    i = window.index
+    if stop is None:
+        stop = len(input)
+    while i < stop and i not in until:
         match = window.search()
         if match:
-            yield match
-            #if match[1] == -283:
-            #    raise Exception(match, i)
-            window.advance(match[0])
-            i += match[0]
+            count = match[0]
+            counts.append(count)
+            values.append(-match[1])
+            window.advance(count)
+            i += count
         else:
-            yield input[i]
+            counts.append(0)
+            values.append(input[i])
             window.next()
             i += 1
 
-def packflags(flags):
-    n = 0
-    for i in range(8):
-        n <<= 1
-        try:
-            if flags[i]:
-                n |= 1
-        except IndexError:
-            pass
-    return n
+    return tokens
 
-def chunkit(it, n):
-    buf = []
-    for x in it:
-        buf.append(x)
-        if n <= len(buf):
-            yield buf
-            buf = []
-    if buf:
-        yield buf
+def _tokenize_counted(input, windowclass, stats):
+    """_tokenize() with a MatchStats watching."""
 
-def compress(input, out):
-    # header
-    out.write(pack("<L", (len(input) << 8) + 0x10))
+    class CountingWindow(windowclass):
+        def match(self, start, bufstart):
+            n = windowclass.match(self, start, bufstart)
+            stats.compared += n + 1
+            return n
 
-    # body
-    length = 0
-    for tokens in chunkit(_compress(input), 8):
-        flags = [type(t) == tuple for t in tokens]
-        out.write(pack(">B", packflags(flags)))
+    window = CountingWindow(input)
+    start = time.perf_counter()
+    tokens = _find_matches(window)
+    stats.search_time += time.perf_counter() - start
 
-        for t in tokens:
-            if type(t) == tuple:
-                count, disp = t
-                count -= 3
-                disp = (-disp) - 1
-                assert 0 <= disp < 4096
-                sh = (count << 12) | disp
-                out.write(pack(">H", sh))
-            else:
-                out.write(pack(">B", t))
+    stats.positions += len(tokens)
+    stats.candidates += window.candidates
+    for count, value in zip(tokens.counts, tokens.values):
+        if count:
+            stats.lengths[count] += 1
+            stats.displacements[value] += 1
+        else:
+            stats.literals += 1
 
-        length += 1
-        length += sum(2 if f else 1 for f in flags)
+    return tokens
 
-    # padding
-    padding = 4 - (length % 4 or 4)
-    if padding:
-        out.write(b'\xff' * padding)
+def _parse_segment(chunk, skip, n, windowclass):
+    """Parses n bytes of chunk greedily, after the first skip bytes, which
+    are only there to fill the window. The last token may run past the n
+    bytes. Returns a Tokens."""
+    window = windowclass(chunk)
+    window.advance(skip)
+    return _find_matches(window, skip + n)
 
-def compress_nlz11(input, out):
-    # header
-    out.write(pack("<L", (len(input) << 8) + 0x11))
+def _tokenize_parallel(input, windowclass=NLZ10Window, jobs=None,
+                       segment_size=None):
+    """Like _tokenize(), but parses the input in segments in a pool of jobs
+    processes (by default, one per CPU).
 
-    # body
-    length = 0
-    for tokens in chunkit(_compress(input, windowclass=NLZ11Window), 8):
-        flags = [type(t) == tuple for t in tokens]
-        out.write(pack(">B", packflags(flags)))
-        length += 1
+    Every position goes into the window whether or not a match covers it,
+    so the longest match at a position doesn't depend on the parse, only
+    on the window before it and the lookahead after it, which each process
+    gets along with its segment. Where the previous segment's last token
+    ends past the start of a segment, the parse is picked up from there
+    here until it lands on a position the process parsed too, and the
+    process's tokens are used from then on. The tokens come out the same
+    as from _tokenize().
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if segment_size is None:
+        segment_size = max(0x10000, -(-len(input) // (jobs * 4)))
+    if jobs <= 1 or len(input) <= segment_size:
+        return _tokenize(input, windowclass)
 
-        for t in tokens:
-            if type(t) == tuple:
-                count, disp = t
-                disp = (-disp) - 1
-                #if disp == 282:
-                #    raise Exception
+    size = windowclass.size
+    lookahead = windowclass.match_max + 3
+
+    def chunk(start, end):
+        context = max(start - size, 0)
+        return input[context:end + lookahead], start - context
+
+    starts = range(0, len(input), segment_size)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for start in starts:
+            end = min(start + segment_size, len(input))
+            futures.append(executor.submit(_parse_segment, *chunk(start, end),
+                                           end - start, windowclass))
+
+        tokens = Tokens()
+        i = 0
+        for start, future in zip(starts, futures):
+            end = min(start + segment_size, len(input))
+            segment = future.result()
+
+            # where each of the segment's tokens starts
+            parsed = {}
+            p = start
+            for k, count in enumerate(segment.counts):
+                parsed[p] = k
+                p += count or 1
+
+            if i not in parsed and i < end:
+                catchup = _parse_until(input, i, end, parsed, windowclass, chunk)
+                tokens.counts.extend(catchup.counts)
+                tokens.values.extend(catchup.values)
+                i += catchup.decompressed_size()
+
+            if i < end:
+                k = parsed[i]
+                tokens.counts.extend(segment.counts[k:])
+                tokens.values.extend(segment.values[k:])
+                i = p
+
+    return tokens
+
+def _parse_until(input, i, end, parsed, windowclass, chunk):
+    """Parses input from i until reaching one of the positions in parsed or
+    end. Returns a Tokens."""
+    data, skip = chunk(i, end)
+    window = windowclass(data)
+    window.advance(skip)
+    # positions in data rather than input
+    context = i - skip
+    until = {p - context for p in parsed}
+    return _find_matches(window, end - context, until=until)
+
+def _compress(input, windowclass=NLZ10Window, stats=None):
+    """Generates a stream of tokens. Either a byte (int) or a tuple of (count,
+    displacement)."""
+    return iter(_tokenize(input, windowclass, stats))
+
+def _emit_nlz10(tokens, out, disp_extra=1):
+    """Appends tokens to the bytearray out as LZ10, in groups of 8 after
+    their flag byte. Overlays store displacements less 3 instead of 1."""
+    counts = tokens.counts
+    values = tokens.values
+    append = out.append
+    n = len(counts)
+
+    for start in range(0, n, 8):
+        # reserve the flag byte and fill it in once the group is done
+        flagpos = len(out)
+        append(0)
+        flags = 0
+        bit = 0x80
+        for k in range(start, min(start + 8, n)):
+            count = counts[k]
+            if count:
+                flags |= bit
+                disp = values[k] - disp_extra
+                assert 3 <= count <= 18 and 0 <= disp < 4096
+                append((count - 3) << 4 | disp >> 8)
+                append(disp & 0xFF)
+            else:
+                append(values[k])
+            bit >>= 1
+        out[flagpos] = flags
+
+def _emit_nlz11(tokens, out):
+    """Appends tokens to the bytearray out as LZ11, in groups of 8 after
+    their flag byte."""
+    counts = tokens.counts
+    values = tokens.values
+    append = out.append
+    n = len(counts)
+
+    for start in range(0, n, 8):
+        # reserve the flag byte and fill it in once the group is done
+        flagpos = len(out)
+        append(0)
+        flags = 0
+        bit = 0x80
+        for k in range(start, min(start + 8, n)):
+            count = counts[k]
+            if count:
+                flags |= bit
+                disp = values[k] - 1
                 assert 0 <= disp <= 0xFFF
                 if count <= 1 + 0xF:
-                    count -= 1
-                    assert 2 <= count <= 0xF
-                    sh = (count << 12) | disp
-                    out.write(pack(">H", sh))
-                    length += 2
+                    assert 3 <= count
+                    append((count - 1) << 4 | disp >> 8)
                 elif count <= 0x11 + 0xFF:
                     count -= 0x11
-                    assert 0 <= count <= 0xFF
-                    b = count >> 4
-                    sh = ((count & 0xF) << 12) | disp
-                    out.write(pack(">BH", b, sh))
-                    length += 3
+                    append(count >> 4)
+                    append((count & 0xF) << 4 | disp >> 8)
                 elif count <= 0x111 + 0xFFFF:
                     count -= 0x111
-                    assert 0 <= count <= 0xFFFF
-                    l = (1 << 28) | (count << 12) | disp
-                    out.write(pack(">L", l))
-                    length += 4
+                    append(0x10 | count >> 12)
+                    append(count >> 4 & 0xFF)
+                    append((count & 0xF) << 4 | disp >> 8)
                 else:
                     raise ValueError(count)
+                append(disp & 0xFF)
             else:
-                out.write(pack(">B", t))
-                length += 1
+                append(values[k])
+            bit >>= 1
+        out[flagpos] = flags
+
+def _compress_to(input, out, format, windowclass, stats, jobs):
+    if jobs == 1:
+        tokens = _tokenize(input, windowclass, stats)
+    elif stats is not None:
+        raise ValueError("stats can't be collected from parallel compression")
+    else:
+        tokens = _tokenize_parallel(input, windowclass, jobs)
+    start = time.perf_counter()
+
+    # the whole file goes out in one write
+    buf = bytearray(pack("<L", (len(input) << 8) + format))
+    if format == 0x10:
+        _emit_nlz10(tokens, buf)
+    else:
+        _emit_nlz11(tokens, buf)
 
     # padding
-    padding = 4 - (length % 4 or 4)
-    if padding:
-        out.write(b'\xff' * padding)
+    buf += b'\xff' * (-len(buf) % 4)
+    out.write(buf)
+
+    if stats is not None:
+        stats.emit_time += time.perf_counter() - start
+
+def compress(input, out, windowclass=NLZ10Window, stats=None, jobs=1):
+    """Compress input in the LZ10 format and write it to out.
+
+    Pass a MatchStats as stats to see what the match finder did.
+
+    With jobs other than 1, matches are found in a pool of that many
+    processes (None for one per CPU). The output is the same.
+    """
+    _compress_to(input, out, 0x10, windowclass, stats, jobs)
+
+def compress_nlz11(input, out, windowclass=NLZ11Window, stats=None, jobs=1):
+    """Compress input in the LZ11 format and write it to out.
+
+    Pass windowclass=NLZ11TreeWindow to find matches with binary trees
+    instead of hash chains. That's only faster on long runs of one byte,
+    such as zero fill; on most data it's several times slower.
+    Pass a MatchStats as stats to see what the match finder did.
+
+    With jobs other than 1, matches are found in a pool of that many
+    processes (None for one per CPU). The output is the same.
+    """
+    _compress_to(input, out, 0x11, windowclass, stats, jobs)
+
+def compress_overlay(input, out, stats=None):
+    """Compress an overlay (or arm9.bin) and write it to out.
+
+    Overlays are compressed backwards from the end and decompressed in
+    place, so the output overwrites the compressed data as it goes. As much
+    of the start of the input is left uncompressed as is needed for the
+    decompressor never to overtake its input.
+
+    If compressing doesn't save any space, the input is written unchanged
+    and False is returned. Otherwise returns True.
+    """
+    tokens = _tokenize(input[::-1], NOverlayWindow, stats)
+    start = time.perf_counter()
+
+    # Decompression writes backwards from the end of the output while
+    # reading backwards from the end of the compressed data. After each
+    # token, what's left to write must still cover what's left to read, or
+    # the next write would clobber input. That holds at every token exactly
+    # when the total savings are at least the savings up to that token, so
+    # cut the token stream where the savings peak and leave the rest of the
+    # input uncompressed.
+    read = written = 0
+    best = 0
+    cut = 0
+    for i, count in enumerate(tokens.counts):
+        if i % 8 == 0:
+            # flag byte
+            read += 1
+        if count:
+            read += 2
+            written += count
+        else:
+            read += 1
+            written += 1
+        if best < written - read:
+            best = written - read
+            cut = i + 1
+    tokens.truncate(cut)
+
+    body = bytearray()
+    _emit_nlz10(tokens, body, disp_extra=3)
+    decompressed_size = tokens.decompressed_size()
+    prefix = len(input) - decompressed_size
+
+    # pad the file to a multiple of 4, then the 8-byte footer
+    padding = -(prefix + len(body)) % 4
+    end_delta = len(body) + padding + 8
+    start_delta = decompressed_size - end_delta
+    if start_delta <= 0:
+        out.write(input)
+        compressed = False
+    else:
+        body.reverse()
+        buf = bytearray(input[:prefix])
+        buf += body
+        buf += b'\xff' * padding
+        buf += pack("<LL", ((padding + 8) << 24) | end_delta, start_delta)
+        out.write(buf)
+        compressed = True
+
+    if stats is not None:
+        stats.emit_time += time.perf_counter() - start
+    return compressed
+
+# Predicted sizes, in bytes, of the input stored as is and compressed as LZ10
+# and LZ11, headers and padding included.
+SizeEstimate = namedtuple('SizeEstimate', 'raw lz10 lz11')
+
+def _split_matches(tokens, match_max=NLZ10Window.match_max):
+    """Returns a copy of tokens with matches longer than match_max split
+    into several of the same displacement, none shorter than 3. That's how
+    LZ11 tokens become LZ10 ones."""
+    split = Tokens()
+    counts = split.counts
+    values = split.values
+    for count, value in zip(tokens.counts, tokens.values):
+        while match_max < count:
+            n = match_max if match_max + 3 <= count else count - 3
+            counts.append(n)
+            values.append(value)
+            count -= n
+        counts.append(count)
+        values.append(value)
+    return split
+
+def _body_sizes(tokens):
+    """Returns (LZ10 size, LZ11 size, bytes covered) of tokens, without
+    headers or padding. Flag bytes are counted fractionally."""
+    literals = lz10 = lz11 = 0
+    refs10 = refs11 = 0
+    for count, n in Counter(tokens.counts).items():
+        if not count:
+            literals = n
+            continue
+        pieces = -(-count // NLZ10Window.match_max)
+        refs10 += pieces * n
+        refs11 += n
+        lz10 += 2 * pieces * n
+        if count <= 1 + 0xF:
+            lz11 += 2 * n
+        elif count <= 0x11 + 0xFF:
+            lz11 += 3 * n
+        else:
+            lz11 += 4 * n
+    covered = tokens.decompressed_size()
+    return (literals + lz10 + (literals + refs10) / 8,
+            literals + lz11 + (literals + refs11) / 8,
+            covered)
+
+def estimate_sizes(input, sample_size=0x1000, samples=16, windowclass=NLZ11Window):
+    """Predicts how big input would be compressed as LZ10 and as LZ11.
+    Returns a SizeEstimate.
+
+    Inputs bigger than samples blocks of sample_size bytes are estimated
+    from that many blocks spread evenly over them (or the middle one, for a
+    single sample), each parsed on its own;
+    smaller ones are parsed whole. Either way there's one pass of the LZ11
+    match finder, and the LZ10 size comes from splitting its longer matches.
+    """
+    if samples < 1:
+        raise ValueError("need at least one sample")
+    size = len(input)
+    if size <= sample_size * samples:
+        blocks = [(0, size)]
+    elif samples == 1:
+        start = (size - sample_size) // 2
+        blocks = [(start, start + sample_size)]
+    else:
+        step = (size - sample_size) / (samples - 1)
+        blocks = [(int(i * step), int(i * step) + sample_size)
+                  for i in range(samples)]
+
+    lz10 = lz11 = covered = 0
+    for start, end in blocks:
+        # parse a window's worth of input before the block too, so the
+        # block's matches can reach back as far as they really would, but
+        # only count the tokens in the block
+        warmup = min(start, windowclass.size)
+        tokens = _tokenize(input[start-warmup:end], windowclass)
+        k = n = 0
+        counts = tokens.counts
+        while k < len(counts) and n + (counts[k] or 1) <= warmup:
+            n += counts[k] or 1
+            k += 1
+        del tokens.counts[:k]
+        del tokens.values[:k]
+        if n < warmup:
+            # a match runs from the warmup into the block; count the part
+            # in the block
+            counts[0] -= warmup - n
+        a, b, c = _body_sizes(tokens)
+        lz10 += a
+        lz11 += b
+        covered += c
+
+    scale = size / covered if covered else 0
+    def total(body):
+        n = 4 + int(-(-body * scale // 1))
+        return n + -n % 4
+    return SizeEstimate(size, total(lz10), total(lz11))
+
+def compress_auto(input, out, refine=False, sample_size=0x1000, samples=16):
+    """Writes input to out in whichever of LZ10, LZ11 or no compression at
+    all comes out smallest. Returns 0x10, 0x11 or None (stored as is).
+
+    The choice is made from estimate_sizes(). With refine, the input is
+    instead compressed both ways and the smaller result is kept; the LZ10
+    output then reuses the LZ11 matches, split up, rather than searching
+    again, so it can differ slightly from what compress() writes.
+    """
+    if not refine:
+        estimate = estimate_sizes(input, sample_size, samples)
+        best = min(estimate.raw, estimate.lz10, estimate.lz11)
+        if best == estimate.raw:
+            out.write(input)
+            return None
+        elif best == estimate.lz10:
+            compress(input, out)
+            return 0x10
+        else:
+            compress_nlz11(input, out)
+            return 0x11
+
+    tokens = _tokenize(input, NLZ11Window)
+    best = bytes(input)
+    format = None
+    for f, emit, t in ((0x10, _emit_nlz10, _split_matches(tokens)),
+                       (0x11, _emit_nlz11, tokens)):
+        buf = bytearray(pack("<L", (len(input) << 8) + f))
+        emit(t, buf)
+        buf += b'\xff' * (-len(buf) % 4)
+        if len(buf) < len(best):
+            best = buf
+            format = f
+    out.write(best)
+    return format
+
+class LZCompressor:
+    """Incremental compressor for LZ10 (format=0x10) and LZ11 (format=0x11),
+    in the style of zlib.compressobj().
+
+    compress() takes the input in chunks and returns compressed data as
+    flag groups are completed; flush() finishes the stream. Only the window,
+    a lookahead of match_max bytes and the input not parsed yet are kept,
+    and the output is the same as compress() and compress_nlz11() produce.
+
+    The header holds the decompressed size. If size is given, the header is
+    returned along with the first output. Otherwise the output starts with
+    the body, and the header is available from header() after flush();
+    compress_stream() patches it in for you.
+    """
+
+    # Parsed input is discarded in multiples of this many windows.
+    discard_windows = 16
+
+    def __init__(self, format=0x10, size=None, windowclass=None):
+        if format == 0x10:
+            self._emit = _emit_nlz10
+            default_windowclass = NLZ10Window
+        elif format == 0x11:
+            self._emit = _emit_nlz11
+            default_windowclass = NLZ11Window
+        else:
+            raise ValueError("unknown format: {:#x}".format(format))
+
+        if windowclass is None:
+            windowclass = default_windowclass
+        if issubclass(windowclass, PrefixIndexWindow):
+            raise ValueError("{} needs the whole input at once".format(windowclass.__name__))
+        if size is not None and 0xFFFFFF < size:
+            raise ValueError("input is too large for the header: {:#x} bytes".format(size))
+
+        self.format = format
+        self.size = size
+        self._window = windowclass(bytearray())
+
+        # The window has to see match_max bytes ahead to find the same
+        # matches as on the whole input, and it only hashes positions with
+        # 3 bytes after them.
+        self._lookahead = windowclass.match_max + 3
+
+        self._tokens = Tokens()
+        self._total = 0
+        self._length = 0
+        self._started = False
+        self._finished = False
+
+    def header(self):
+        """Returns the 4-byte header, once the size is known."""
+        size = self.size
+        if size is None:
+            if not self._finished:
+                raise ValueError("the size isn't known until flush() is called")
+            size = self._total
+        if 0xFFFFFF < size:
+            raise ValueError("input is too large for the header: {:#x} bytes".format(size))
+        return pack("<L", (size << 8) + self.format)
+
+    def compress(self, data):
+        """Compresses data, returning whatever output is ready."""
+        if self._finished:
+            raise ValueError("compressor has already been flushed")
+
+        self._window.data += data
+        self._total += len(data)
+        out = bytearray()
+        if not self._started and self.size is not None:
+            out += self.header()
+        self._started = True
+        self._parse(out, final=False)
+        return bytes(out)
+
+    def flush(self):
+        """Compresses the rest of the input and finishes the stream."""
+        if self._finished:
+            raise ValueError("compressor has already been flushed")
+
+        if self.size is not None and self._total != self.size:
+            raise ValueError("got {:#x} bytes of input, expected {:#x}"
+                             .format(self._total, self.size))
+
+        out = bytearray()
+        if not self._started and self.size is not None:
+            out += self.header()
+        self._started = True
+        self._parse(out, final=True)
+
+        if self._tokens:
+            length = len(out)
+            self._emit(self._tokens, out)
+            self._length += len(out) - length
+            self._tokens.clear()
+
+        # padding
+        padding = 4 - (self._length % 4 or 4)
+        out += b'\xff' * padding
+
+        self._finished = True
+        return bytes(out)
+
+    def _parse(self, out, final):
+        window = self._window
+        tokens = self._tokens
+
+        if final:
+            stop = len(window.data)
+        else:
+            stop = len(window.data) - self._lookahead
+        _find_matches(window, stop, tokens)
+
+        # only whole flag groups go out; flush() sends the rest
+        n = len(tokens) - len(tokens) % 8
+        if n:
+            length = len(out)
+            self._emit(tokens.take(n), out)
+            self._length += len(out) - length
+
+        size = window.size
+        behind = window.index - size
+        if self.discard_windows * size <= behind:
+            window.discard(behind - behind % size)
+
+def compress_stream(f, out, format=0x10, size=None, windowclass=None,
+                    chunk_size=0x10000):
+    """Compress a file-like object f to out, a piece at a time.
+
+    If size isn't given, out has to be seekable, so that the header can be
+    filled in at the end.
+    """
+    compressor = LZCompressor(format, size, windowclass)
+
+    if size is None:
+        if not (hasattr(out, 'seekable') and out.seekable()):
+            raise ValueError("the size must be given to compress to an unseekable stream")
+        start = out.tell()
+        out.write(b'\x00' * 4)
+
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush())
+
+    if size is None:
+        end = out.tell()
+        out.seek(start)
+        out.write(compressor.header())
+        out.seek(end)
+
+class CompressionCache:
+    """A directory of compressed files, so that unchanged inputs don't have
+    to be compressed again.
+
+    Entries are keyed by a digest of the input, the format and the window
+    class and its parameters. When the entries add up to more than
+    max_size bytes, the least recently used ones are deleted. Several
+    processes can share a directory; the size limit is then approximate.
+    """
+
+    # Bump this whenever a change to the compressor changes its output, so
+    # that stale entries are never used.
+    version = 1
+
+    def __init__(self, path, max_size=256 << 20):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+
+    def key(self, input, format=0x10, windowclass=None):
+        if format == 'overlay':
+            windowclass = NOverlayWindow
+        elif windowclass is None:
+            windowclass = NLZ11Window if format == 0x11 else NLZ10Window
+        # not the module, which is __main__ when compress.py is run as a
+        # script, so the command line and the library share entries
+        settings = "{} {} {} {} {} {} {} {}".format(
+            self.version, format, windowclass.__qualname__, windowclass.size,
+            windowclass.match_min, windowclass.match_max, windowclass.disp_min,
+            getattr(windowclass, 'nice_len', None))
+        h = hashlib.sha256(settings.encode('ascii') + b'\0')
+        h.update(input)
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Returns the cached output for key, or None."""
+        path = self._entry(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # mark it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data):
+        if self.max_size < len(data):
+            return
+        path = self._entry(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data)
+        if self.max_size < self._size:
+            self.evict()
+
+    def _entries(self):
+        """Yields (mtime, size, path) for every entry."""
+        try:
+            dirs = os.scandir(self.path)
+        except FileNotFoundError:
+            return
+        with dirs:
+            for d in dirs:
+                if not d.is_dir():
+                    continue
+                with os.scandir(d.path) as files:
+                    for f in files:
+                        if f.name.endswith('.tmp'):
+                            continue
+                        st = f.stat()
+                        yield st.st_mtime, st.st_size, f.path
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in
+        max_size."""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def compress(self, input, format=0x10, windowclass=None, stats=None, jobs=1):
+        """Returns input compressed as by compress(), compress_nlz11() or,
+        if format is 'overlay', compress_overlay(), from the cache if it's
+        there."""
+        key = self.key(input, format, windowclass)
+        data = self.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+
+        out = BytesIO()
+        if format == 'overlay':
+            compress_overlay(input, out, stats=stats)
+        elif format == 0x11:
+            compress_nlz11(input, out, windowclass or NLZ11Window, stats, jobs)
+        elif format == 0x10:
+            compress(input, out, windowclass or NLZ10Window, stats, jobs)
+        else:
+            raise ValueError("unknown format: {!r}".format(format))
+        data = out.getvalue()
+        self.put(key, data)
+        return data
 
 def dump_compress_nlz11(input, out):
     # body
@@ -245,11 +1295,83 @@ def dump_compress_nlz11(input, out):
     from pprint import pprint
     pprint(list(dump()))
 
-if __name__ == '__main__':
-    from sys import stdout, argv
-    data = open(argv[1], "rb").read()
-    stdout = stdout.detach()
-    #compress(data, stdout)
-    compress_nlz11(data, stdout)
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    usage = ("usage: compress.py [--stats] [-j JOBS] [--cache DIR [--cache-size BYTES]] FILE\n"
+             "       compress.py --auto|--estimate FILE")
+    mode = None
+    stats = None
+    jobs = 1
+    cache = None
+    cache_size = 256 << 20
+    paths = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--stats':
+            stats = MatchStats()
+        elif arg in ('--auto', '--estimate'):
+            mode = arg
+        elif arg in ('--cache', '--cache-size', '-j', '--jobs'):
+            if not args:
+                print(usage, file=stderr)
+                return 2
+            value = args.pop(0)
+            if arg == '--cache':
+                cache = value
+                continue
+            try:
+                value = int(value)
+            except ValueError:
+                print(usage, file=stderr)
+                return 2
+            if arg == '--cache-size':
+                cache_size = value
+            else:
+                jobs = value
+        else:
+            paths.append(arg)
+
+    if len(paths) != 1 or (stats is not None and jobs != 1) or \
+       (mode is not None and (stats is not None or jobs != 1 or cache is not None)):
+        print(usage, file=stderr)
+        return 2
+    args = paths
 
-    #dump_compress_nlz11(data, stdout)
+    try:
+        with open(args[0], "rb") as f:
+            data = f.read()
+    except IOError as e:
+        print(e, file=stderr)
+        return 2
+
+    stdout = sys.stdout
+    if hasattr(stdout, 'buffer'):
+        stdout = stdout.buffer
+    if mode == '--estimate':
+        print("raw: {}\nlz10: {}\nlz11: {}".format(*estimate_sizes(data)))
+        return 0
+    elif mode == '--auto':
+        format = compress_auto(data, stdout, refine=True)
+        stdout.flush()
+        print({None: "stored", 0x10: "lz10", 0x11: "lz11"}[format], file=stderr)
+        return 0
+    elif cache is not None:
+        cache = CompressionCache(cache, cache_size)
+        stdout.write(cache.compress(data, 0x11, stats=stats, jobs=jobs))
+    else:
+        compress_nlz11(data, stdout, stats=stats, jobs=jobs)
+    stdout.flush()
+
+    if stats is not None:
+        if cache is not None and cache.hits:
+            print("found in the cache", file=stderr)
+        else:
+            print(stats, file=stderr)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import mmap
+import time
+import asyncio
+import hashlib
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from sys import stdin, stdout, stderr, exit
 from os import SEEK_SET, SEEK_CUR, SEEK_END
 from errno import EPIPE
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from, calcsize
 
 __all__ = ('decompress', 'decompress_file', 'decompress_bytes',
-           'decompress_overlay', 'DecompressionError')
+           'decompress_into', 'get_decompressed_size', 'decompress_to_file',
+           'decompress_overlay', 'decompress_batch', 'extract_overlays',
+           'read_overlay_table', 'LZDecompressor', 'DecompressionCache',
+           'AsyncDecompressor', 'SeekIndex', 'DecompressionError')
 
 class DecompressionError(ValueError):
     pass
@@ -22,151 +34,344 @@ def bits(byte):
             (byte >> 1) & 1,
             (byte) & 1)
 
+def _flag_runs(byte):
+    runs = []
+    run = 0
+    for flag in bits(byte):
+        if flag:
+            runs.append(run)
+            run = 0
+        else:
+            run += 1
+    runs.append(run)
+    return tuple(runs)
+
+# For each flag byte, the number of literals before each reference, followed
+# by the number of literals after the last one. So 0x08 is (4, 3): four
+# literals, a reference, three literals.
+FLAG_RUNS = tuple(_flag_runs(b) for b in range(256))
+
+def _copy_literals(indata, pos, data, o, n):
+    """Copies n literal bytes from indata[pos:] to data[o:]."""
+    chunk = indata[pos:pos+n]
+    if len(chunk) < n:
+        raise DecompressionError("compressed data is truncated")
+    data[o:o+n] = chunk
+
+def _copy_reference(data, o, count, disp, start, end):
+    """Copies count bytes from disp bytes back to data[o:]."""
+    if end < o + count:
+        raise DecompressionError("decompressed size does not match the expected size")
+    if o - start < disp:
+        raise DecompressionError("displacement {:#x} reaches back before the start of the output".format(disp))
+
+    src = o - disp
+    if count <= disp:
+        data[o:o+count] = data[src:src+count]
+    else:
+        # The reference overlaps its own output, so it repeats the last
+        # disp bytes.
+        pattern = bytes(data[src:o])
+        data[o:o+count] = (pattern * (count // disp + 1))[:count]
+
 def decompress_raw_lzss10(indata, decompressed_size, _overlay=False):
     """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    data = bytearray()
+    data = bytearray(decompressed_size)
+    _decompress_raw_lzss10_into(indata, data, 0, decompressed_size, _overlay)
+    return data
 
-    it = iter(indata)
+def _decompress_raw_lzss10_into(indata, data, start, end, _overlay=False,
+                                pos=0):
+    """Decompress LZSS-compressed bytes from indata[pos:] into
+    data[start:end].
 
+    Returns the position in indata after the last byte read."""
     if _overlay:
         disp_extra = 3
     else:
         disp_extra = 1
 
-    def writebyte(b):
-        data.append(b)
-    def readbyte():
-        return next(it)
-    def readshort():
-        # big-endian
-        a = next(it)
-        b = next(it)
-        return (a << 8) | b
-    def copybyte():
-        data.append(next(it))
-
-    while len(data) < decompressed_size:
-        b = readbyte()
-        flags = bits(b)
-        for flag in flags:
-            if flag == 0:
-                copybyte()
-            elif flag == 1:
-                sh = readshort()
+    o = start
+    try:
+        while o < end:
+            b = indata[pos]
+            pos += 1
+            if b == 0:
+                # A whole group of literals. Keep going as long as the flag
+                # bytes stay zero.
+                while True:
+                    n = min(8, end - o)
+                    _copy_literals(indata, pos, data, o, n)
+                    pos += n
+                    o += n
+                    if end <= o or indata[pos] != 0:
+                        break
+                    pos += 1
+                continue
+
+            runs = FLAG_RUNS[b]
+            last = len(runs) - 1
+            for i, run in enumerate(runs):
+                if run:
+                    n = min(run, end - o)
+                    _copy_literals(indata, pos, data, o, n)
+                    pos += n
+                    o += n
+                if end <= o or i == last:
+                    break
+
+                # big-endian
+                sh = (indata[pos] << 8) | indata[pos+1]
+                pos += 2
                 count = (sh >> 0xc) + 3
                 disp = (sh & 0xfff) + disp_extra
+                _copy_reference(data, o, count, disp, start, end)
+                o += count
+    except IndexError:
+        raise DecompressionError("compressed data is truncated")
 
-                for _ in range(count):
-                    writebyte(data[-disp])
-            else:
-                raise ValueError(flag)
+    return pos
 
-            if decompressed_size <= len(data):
-                break
+def decompress_raw_lzss11(indata, decompressed_size):
+    """Decompress LZSS-compressed bytes. Returns a bytearray."""
+    data = bytearray(decompressed_size)
+    _decompress_raw_lzss11_into(indata, data, 0, decompressed_size)
+    return data
 
-    if len(data) != decompressed_size:
-        raise DecompressionError("decompressed size does not match the expected size")
+def _decompress_raw_lzss11_into(indata, data, start, end, pos=0):
+    """Decompress LZSS-compressed bytes from indata[pos:] into
+    data[start:end].
 
-    return data
+    Returns the position in indata after the last byte read."""
+    o = start
+    try:
+        while o < end:
+            b = indata[pos]
+            pos += 1
+            if b == 0:
+                # A whole group of literals. Keep going as long as the flag
+                # bytes stay zero.
+                while True:
+                    n = min(8, end - o)
+                    _copy_literals(indata, pos, data, o, n)
+                    pos += n
+                    o += n
+                    if end <= o or indata[pos] != 0:
+                        break
+                    pos += 1
+                continue
 
-def decompress_raw_lzss11(indata, decompressed_size):
-    """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    data = bytearray()
-
-    it = iter(indata)
-
-    def writebyte(b):
-        data.append(b)
-    def readbyte():
-        return next(it)
-    def copybyte():
-        data.append(next(it))
-
-    while len(data) < decompressed_size:
-        b = readbyte()
-        flags = bits(b)
-        for flag in flags:
-            if flag == 0:
-                copybyte()
-            elif flag == 1:
-                b = readbyte()
+            runs = FLAG_RUNS[b]
+            last = len(runs) - 1
+            for i, run in enumerate(runs):
+                if run:
+                    n = min(run, end - o)
+                    _copy_literals(indata, pos, data, o, n)
+                    pos += n
+                    o += n
+                if end <= o or i == last:
+                    break
+
+                b = indata[pos]
                 indicator = b >> 4
 
                 if indicator == 0:
                     # 8 bit count, 12 bit disp
                     # indicator is 0, don't need to mask b
                     count = (b << 4)
-                    b = readbyte()
+                    b = indata[pos+1]
                     count += b >> 4
                     count += 0x11
+                    pos += 2
                 elif indicator == 1:
                     # 16 bit count, 12 bit disp
-                    count = ((b & 0xf) << 12) + (readbyte() << 4)
-                    b = readbyte()
+                    count = ((b & 0xf) << 12) + (indata[pos+1] << 4)
+                    b = indata[pos+2]
                     count += b >> 4
                     count += 0x111
+                    pos += 3
                 else:
                     # indicator is count (4 bits), 12 bit disp
                     count = indicator
                     count += 1
+                    pos += 1
 
-                disp = ((b & 0xf) << 8) + readbyte()
+                disp = ((b & 0xf) << 8) + indata[pos]
                 disp += 1
+                pos += 1
 
-                try:
-                    for _ in range(count):
-                        writebyte(data[-disp])
-                except IndexError:
-                    raise Exception(count, disp, len(data), sum(1 for x in it) )
-            else:
-                raise ValueError(flag)
+                _copy_reference(data, o, count, disp, start, end)
+                o += count
+    except IndexError:
+        raise DecompressionError("compressed data is truncated")
 
-            if decompressed_size <= len(data):
+    return pos
+
+
+def _map_file(f):
+    """Returns a read-only mmap of the whole of file f, or None if it can't
+    be mapped (e.g. it's a pipe, or empty)."""
+    try:
+        fileno = f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+def _decompress_raw_overlay_into(indata, data, start, end, pos, stop):
+    """Decompress overlay-compressed bytes into data[start:end].
+
+    Overlays are decompressed backwards: the input is read from indata[pos-1]
+    down to indata[stop], and the output is written from data[end-1] down
+    to data[start]. Nothing gets reversed or copied along the way.
+
+    Returns the position in indata of the last byte read."""
+    o = end
+    while start < o:
+        if pos <= stop:
+            raise DecompressionError("compressed data is truncated")
+        pos -= 1
+        b = indata[pos]
+        if b == 0:
+            # A whole group of literals. Read backwards, they come out in
+            # the same order as they are written.
+            while True:
+                n = min(8, o - start)
+                if pos - n < stop:
+                    raise DecompressionError("compressed data is truncated")
+                data[o-n:o] = indata[pos-n:pos]
+                pos -= n
+                o -= n
+                if o <= start or pos <= stop or indata[pos-1] != 0:
+                    break
+                pos -= 1
+            continue
+
+        runs = FLAG_RUNS[b]
+        last = len(runs) - 1
+        for i, run in enumerate(runs):
+            if run:
+                n = min(run, o - start)
+                if pos - n < stop:
+                    raise DecompressionError("compressed data is truncated")
+                data[o-n:o] = indata[pos-n:pos]
+                pos -= n
+                o -= n
+            if o <= start or i == last:
                 break
 
-    if len(data) != decompressed_size:
-        raise DecompressionError("decompressed size does not match the expected size")
+            if pos - 2 < stop:
+                raise DecompressionError("compressed data is truncated")
+            sh = (indata[pos-1] << 8) | indata[pos-2]
+            pos -= 2
+            count = (sh >> 0xc) + 3
+            disp = (sh & 0xfff) + 3
 
-    return data
+            if o - start < count:
+                raise DecompressionError("decompressed size does not match the expected size")
+            if end - o < disp:
+                raise DecompressionError("displacement {:#x} reaches back before the start of the output".format(disp))
 
+            src = o + disp
+            if count <= disp:
+                data[o-count:o] = data[src-count:src]
+            else:
+                # The reference overlaps its own output, so it repeats the
+                # disp bytes above it, lined up at the top.
+                pattern = bytes(data[o:src])
+                data[o-count:o] = (pattern * (count // disp + 1))[-count:]
+            o -= count
 
-def decompress_overlay(f, out):
-    # the compression header is at the end of the file
-    f.seek(-8, SEEK_END)
-    header = f.read(8)
+    return pos
 
+def _decode_overlay(m, start, end):
+    """Decompresses the overlay in m[start:end], which can be any buffer,
+    such as an mmap. Returns the length of the uncompressed part at its
+    start and a bytearray with the decompressed data that follows it."""
+    if end - start < 8:
+        raise DecompressionError("file is too short to be an overlay")
+
+    # the compression header is at the end of the file
     # decompression goes backwards.
     # end < here < start
 
     # end_delta == here - decompression end address
     # start_delta == decompression start address - here
-    end_delta, start_delta = unpack("<LL", header)
-
-    filelen = f.tell()
+    end_delta, start_delta = unpack_from("<LL", m, end - 8)
 
     padding = end_delta >> 0x18
     end_delta &= 0xFFFFFF
     decompressed_size = start_delta + end_delta
+    if end - start < end_delta or end_delta < padding:
+        raise DecompressionError("overlay header is out of range")
+    # a flag byte and 8 references of 18 bytes each is as good as it gets;
+    # check before trusting the footer with an allocation
+    if -(-(end_delta - padding) * 144 // 17) < decompressed_size:
+        raise DecompressionError("overlay header is out of range")
 
-    f.seek(-end_delta, SEEK_END)
+    data = bytearray(decompressed_size)
+    _decompress_raw_overlay_into(m, data, 0, decompressed_size,
+                                 end - padding, end - end_delta)
+    return end - start - end_delta, data
 
-    data = bytearray()
-    data.extend(f.read(end_delta - padding))
-    data.reverse()
+def _copy_file_range(f, out, offset, count):
+    """Copies count bytes from offset in file f to the current position in
+    out, without passing them through Python if the OS allows. Returns
+    False, having copied nothing, if it doesn't."""
+    if not hasattr(os, 'sendfile'):
+        return False
+    try:
+        infd = f.fileno()
+        outfd = out.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
 
-    #stdout.write(data.tostring())
+    out.flush()
+    while count:
+        try:
+            sent = os.sendfile(outfd, infd, offset, count)
+        except OSError:
+            if offset == 0:
+                return False
+            raise
+        if not sent:
+            raise IOError("unexpected end of file")
+        offset += sent
+        count -= sent
 
-    uncompressed_data = decompress_raw_lzss10(data, decompressed_size,
-                                              _overlay=True)
-    uncompressed_data.reverse()
+    try:
+        # sync the position of a buffered out with its file
+        out.seek(0, SEEK_CUR)
+    except (AttributeError, OSError, ValueError):
+        pass
+    return True
 
+def decompress_overlay(f, out):
     # first we write up to the portion of the file which was "overwritten" by
     # the decompressed data, then the decompressed data itself.
-    # i wonder if it's possible for decompression to overtake the compressed
-    # data, so that the decompression code is reading its own output...
-    f.seek(0, SEEK_SET)
-    out.write(f.read(filelen - end_delta))
-    out.write(uncompressed_data)
+    m = _map_file(f)
+    if m is None:
+        f.seek(0, SEEK_SET)
+        return _decompress_overlay_buffer(f.read(), out)
+
+    with m:
+        prefix, data = _decode_overlay(m, 0, len(m))
+        if not _copy_file_range(f, out, 0, prefix):
+            with memoryview(m) as view:
+                out.write(view[:prefix])
+    out.write(data)
+
+def _decompress_overlay_buffer(m, out, start=0, end=None):
+    """decompress_overlay() for an overlay in memory at m[start:end], e.g. in
+    an mmap."""
+    if end is None:
+        end = len(m)
+    prefix, data = _decode_overlay(m, start, end)
+    with memoryview(m) as view:
+        out.write(view[start:start+prefix])
+    out.write(data)
 
 def decompress(obj):
     """Decompress LZSS-compressed bytes or a file-like object.
@@ -180,50 +385,856 @@ def decompress(obj):
     else:
         return decompress_bytes(obj)
 
-def decompress_bytes(data):
-    """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    header = data[:4]
+def _parse_header(header):
+    """Returns the raw decompression function and the decompressed size for
+    a 4-byte LZSS header."""
+    if len(header) < 4:
+        raise DecompressionError("file is too short to be lzss-compressed")
     if header[0] == 0x10:
-        decompress_raw = decompress_raw_lzss10
+        decompress_raw = _decompress_raw_lzss10_into
     elif header[0] == 0x11:
-        decompress_raw = decompress_raw_lzss11
+        decompress_raw = _decompress_raw_lzss11_into
     else:
         raise DecompressionError("not as lzss-compressed file")
 
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+    decompressed_size = unpack("<L", header)[0] >> 8
+    return decompress_raw, decompressed_size
+
+def decompress_bytes(data, max_length=None):
+    """Decompress LZSS-compressed bytes. Returns a bytearray.
 
-    data = data[4:]
-    return decompress_raw(data, decompressed_size)
+    If max_length is given, stops after that many bytes of output and only
+    reads as much of the input as it takes to get them."""
+    if max_length is not None:
+        return _decompress_some(LZDecompressor(), data, 0, max_length)[0]
+
+    data = memoryview(data)
+    decompress_raw, decompressed_size = _parse_header(data[:4])
+
+    out = bytearray(decompressed_size)
+    decompress_raw(data[4:], out, 0, decompressed_size)
+    return out
+
+def decompress_into(data, buffer, offset=0):
+    """Decompress LZSS-compressed bytes into a writable buffer, such as a
+    bytearray, memoryview or mmap, starting at offset.
+
+    The input isn't copied, and nothing is allocated for the output.
+    Returns the decompressed size.
+    """
+    data = memoryview(data)
+    decompress_raw, decompressed_size = _parse_header(data[:4])
+
+    with memoryview(buffer) as out:
+        if len(out) < offset + decompressed_size:
+            raise ValueError("buffer is too small: need {} bytes at offset {}"
+                             .format(decompressed_size, offset))
+        decompress_raw(data[4:], out, offset, offset + decompressed_size)
+
+    return decompressed_size
+
+def get_decompressed_size(data):
+    """Returns the decompressed size from the header of LZSS-compressed
+    bytes, for sizing a buffer for decompress_into()."""
+    _, size = _parse_header(memoryview(data)[:4])
+    return size
 
 def decompress_file(f):
     """Decompress an LZSS-compressed file. Returns a bytearray.
 
-    This isn't any more efficient than decompress_bytes, as it reads
-    the entire file into memory. It is offered as a convenience.
+    Regular files are mapped into memory and decompressed straight from the
+    mapping. Anything else (like a pipe) is read into memory first. Use
+    LZDecompressor to decompress a stream a piece at a time.
     """
-    header = f.read(4)
-    if header[0] == 0x10:
-        decompress_raw = decompress_raw_lzss10
-    elif header[0] == 0x11:
-        decompress_raw = decompress_raw_lzss11
-    else:
-        raise DecompressionError("not as lzss-compressed file")
+    m = _map_file(f)
+    if m is not None:
+        with m:
+            pos = f.tell()
+            decompress_raw, decompressed_size = _parse_header(m[pos:pos+4])
+            out = bytearray(decompressed_size)
+            decompress_raw(m, out, 0, decompressed_size, pos=pos+4)
+        f.seek(0, SEEK_END)
+        return out
 
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+    header = f.read(4)
+    decompress_raw, decompressed_size = _parse_header(header)
 
     data = f.read()
-    return decompress_raw(data, decompressed_size)
+    out = bytearray(decompressed_size)
+    decompress_raw(data, out, 0, decompressed_size)
+    return out
+
+def decompress_to_file(f, out):
+    """Decompress an LZSS-compressed file into the file out, at its current
+    position. Returns the decompressed size.
+
+    If out is a regular file opened for reading and writing (e.g. "w+b"),
+    it is extended to fit, mapped into memory and decompressed into
+    directly. Otherwise the output is decompressed into memory and written.
+    """
+    m = _map_file(f)
+    if m is None:
+        data = decompress_file(f)
+        out.write(data)
+        return len(data)
+
+    with m:
+        pos = f.tell()
+        decompress_raw, decompressed_size = _parse_header(m[pos:pos+4])
+
+        # pipes and the like can't be extended and mapped, or even asked
+        # where they are; write-only and append-mode files can't be mapped
+        seekable = hasattr(out, 'seekable') and out.seekable()
+        outmap = None
+        if seekable:
+            out.flush()
+            start = out.tell()
+            end = start + decompressed_size
+        if seekable and hasattr(out, 'readable') and out.readable():
+            size = out.seek(0, SEEK_END)
+            try:
+                fileno = out.fileno()
+                out.truncate(max(end, size))
+                outmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_WRITE)
+            except (AttributeError, OSError, ValueError):
+                # don't leave the file extended with zeros
+                out.truncate(size)
+                outmap = None
+
+        if outmap is None:
+            data = bytearray(decompressed_size)
+            decompress_raw(m, data, 0, decompressed_size, pos=pos+4)
+            if seekable:
+                out.seek(start)
+            out.write(data)
+        else:
+            with outmap:
+                decompress_raw(m, outmap, start, end, pos=pos+4)
+            out.seek(end)
+    f.seek(0, SEEK_END)
+
+    return decompressed_size
+
+class DecompressionCache:
+    """Remembers what was decompressed recently, so that decompressing the
+    same data again just returns the earlier result.
+
+    Results are keyed by a digest of the compressed data and kept up to a
+    total of max_size bytes, dropping the least recently used first. They
+    are returned as bytes, so they can be handed out to several threads at
+    once; the cache itself can be shared between threads too.
+    """
+
+    def __init__(self, max_size=64 << 20):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return data
+
+    def _put(self, key, data):
+        if self.max_size < len(data):
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self.size += len(data)
+            while self.max_size < self.size:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+    def decompress_bytes(self, data):
+        """Like decompress_bytes(), but returns bytes, from the cache if
+        possible."""
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        out = self._get(key)
+        if out is None:
+            out = bytes(decompress_bytes(data))
+            self._put(key, out)
+        return out
+
+    def decompress_file(self, f):
+        """Like decompress_file(), but returns bytes, from the cache if
+        possible."""
+        m = _map_file(f)
+        if m is None:
+            return self.decompress_bytes(f.read())
+
+        pos = f.tell()
+        h = hashlib.blake2b(digest_size=16)
+        with m, memoryview(m) as view, view[pos:] as rest:
+            h.update(rest)
+        key = h.digest()
+
+        out = self._get(key)
+        if out is None:
+            out = bytes(decompress_file(f))
+            self._put(key, out)
+        else:
+            f.seek(0, SEEK_END)
+        return out
+
+class AsyncDecompressor:
+    """Decompresses for asyncio code without blocking the event loop.
+
+    Inputs of more than inline_size bytes are decompressed in executor (by
+    default, the loop's default thread pool). A ProcessPoolExecutor gets
+    around the GIL, at the cost of copying the data to and from the worker.
+    Smaller inputs are decompressed right away, which is quicker than
+    handing them off.
+
+    At most max_concurrency inputs are read and decompressed at once.
+    Callers beyond that wait their turn before anything is read from their
+    streams, so a slow pool pushes back on the clients.
+    """
+
+    def __init__(self, executor=None, max_concurrency=4, inline_size=0x1000):
+        self.executor = executor
+        self.inline_size = inline_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def decompress(self, source):
+        """Decompresses bytes, or everything up to EOF from an
+        asyncio.StreamReader. Returns a bytearray."""
+        async with self._semaphore:
+            if isinstance(source, asyncio.StreamReader):
+                try:
+                    header = await source.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    raise DecompressionError("not as lzss-compressed file")
+                # fail before reading the rest if it's not LZ10 or LZ11
+                _parse_header(header)
+                data = header + await source.read()
+            else:
+                data = source
+
+            if len(data) <= self.inline_size:
+                return decompress_bytes(data)
+
+            if not isinstance(data, (bytes, bytearray)):
+                # memoryviews and mmaps can't be sent to another process
+                data = bytes(data)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, decompress_bytes, data)
+
+class LZDecompressor:
+    """Incremental decompressor for LZ10 and LZ11 streams, in the style of
+    zlib.decompressobj() and bz2.BZ2Decompressor.
+
+    Feed it compressed data in chunks of any size with decompress(); it
+    returns whatever output is available so far. Only the last 4 KB of
+    output (the furthest a reference can reach) and any input that doesn't
+    make up a whole token yet are kept between calls.
+    """
+
+    # How much output to keep around for references
+    window_size = 0x1000
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._window = bytearray()
+        self._lz11 = None
+        self._size = None
+        self._produced = 0
+
+        # The current flag byte, shifted so the next flag is the top bit,
+        # and how many flags are left in it.
+        self._flags = 0
+        self._nflags = 0
+
+        # A reference which hasn't been copied out entirely yet
+        self._copy_count = 0
+        self._copy_disp = 0
+
+        self.eof = False
+        self.unused_data = b''
+        self.needs_input = True
+
+    def decompress(self, data, max_length=-1):
+        """Decompress data, returning the output as bytes.
+
+        If max_length is nonnegative, at most max_length bytes are returned
+        and any further output is held back until the next call, which may
+        pass b'' as data. needs_input tells whether more input is required
+        to make progress.
+
+        Once the end of the stream is reached, eof is set and anything past
+        it (usually padding) is stored in unused_data.
+        """
+        if self.eof:
+            raise EOFError("End of stream already reached")
+
+        buf = self._buf
+        buf += data
+
+        if self._size is None:
+            if len(buf) < 4:
+                self.needs_input = True
+                return b''
+            if buf[0] == 0x10:
+                self._lz11 = False
+            elif buf[0] == 0x11:
+                self._lz11 = True
+            else:
+                raise DecompressionError("not as lzss-compressed file")
+            self._size = unpack("<L", buf[:4])[0] >> 8
+            del buf[:4]
+
+        window = self._window
+        base = len(window)
+        limit = self._size - self._produced
+        if 0 <= max_length < limit:
+            limit = max_length
+        target = base + limit
+
+        try:
+            pos = self._decode(buf, window, base, target)
+        finally:
+            self._produced += len(window) - base
+
+        out = bytes(window[base:])
+        del window[:-self.window_size]
+        del buf[:pos]
+
+        if self._produced == self._size:
+            self.eof = True
+            self.unused_data = bytes(buf)
+            del buf[:]
+            self.needs_input = False
+        else:
+            # If we stopped short of the limit, we ran out of input.
+            self.needs_input = len(out) < limit
+
+        return out
+
+    def flush(self):
+        """Returns any output held back by max_length.
+
+        Raises DecompressionError if the stream isn't complete."""
+        if self.eof:
+            return b''
+        out = self.decompress(b'')
+        if not self.eof:
+            raise DecompressionError("compressed data is truncated")
+        return out
+
+    def _decode(self, buf, window, base, target):
+        """Decodes tokens from buf, appending output to window until it is
+        target bytes long or the input runs out. Output from this call
+        starts at window[base]. Returns the number of input bytes used."""
+        pos = 0
+        flags = self._flags
+        nflags = self._nflags
+        try:
+            while len(window) < target:
+                if self._copy_count:
+                    n = min(self._copy_count, target - len(window))
+                    disp = self._copy_disp
+                    src = len(window) - disp
+                    if n <= disp:
+                        window += window[src:src+n]
+                    else:
+                        pattern = window[src:]
+                        window += (pattern * (n // disp + 1))[:n]
+                    self._copy_count -= n
+                    continue
+
+                if not nflags:
+                    if len(buf) <= pos:
+                        break
+                    flags = buf[pos]
+                    nflags = 8
+                    pos += 1
+
+                if not flags & 0x80:
+                    # Copy all the literals up to the next reference at once.
+                    run = min(FLAG_RUNS[flags][0], nflags,
+                              len(buf) - pos, target - len(window))
+                    if not run:
+                        break
+                    window += buf[pos:pos+run]
+                    pos += run
+                    flags = (flags << run) & 0xff
+                    nflags -= run
+                    continue
+
+                avail = len(buf) - pos
+                if avail < 2:
+                    break
+                b = buf[pos]
+                if not self._lz11:
+                    sh = (b << 8) | buf[pos+1]
+                    count = (sh >> 0xc) + 3
+                    disp = (sh & 0xfff) + 1
+                    pos += 2
+                else:
+                    indicator = b >> 4
+                    if indicator == 0:
+                        # 8 bit count, 12 bit disp
+                        if avail < 3:
+                            break
+                        count = (b << 4) + (buf[pos+1] >> 4) + 0x11
+                        disp = ((buf[pos+1] & 0xf) << 8) + buf[pos+2] + 1
+                        pos += 3
+                    elif indicator == 1:
+                        # 16 bit count, 12 bit disp
+                        if avail < 4:
+                            break
+                        count = (((b & 0xf) << 12) + (buf[pos+1] << 4) +
+                                 (buf[pos+2] >> 4) + 0x111)
+                        disp = ((buf[pos+2] & 0xf) << 8) + buf[pos+3] + 1
+                        pos += 4
+                    else:
+                        # indicator is count (4 bits), 12 bit disp
+                        count = indicator + 1
+                        disp = ((b & 0xf) << 8) + buf[pos+1] + 1
+                        pos += 2
+
+                produced = self._produced + len(window) - base
+                if produced < disp:
+                    raise DecompressionError("displacement {:#x} reaches back before the start of the output".format(disp))
+                if self._size - produced < count:
+                    raise DecompressionError("decompressed size does not match the expected size")
+
+                flags = (flags << 1) & 0xff
+                nflags -= 1
+                self._copy_count = count
+                self._copy_disp = disp
+        finally:
+            self._flags = flags
+            self._nflags = nflags
+
+        return pos
+
+def _decompress_some(decompressor, data, pos, length):
+    """Feeds data[pos:] to decompressor, a piece at a time, until it has
+    produced length bytes or reached the end. Returns the output as a
+    bytearray, and the position in data after the last piece fed."""
+    out = bytearray()
+    while len(out) < length and not decompressor.eof:
+        if decompressor.needs_input:
+            piece = data[pos:pos+0x1000]
+            if not piece:
+                raise DecompressionError("compressed data is truncated")
+            pos += len(piece)
+        else:
+            piece = b''
+        out += decompressor.decompress(piece, length - len(out))
+    return out, pos
+
+Checkpoint = namedtuple('Checkpoint',
+    'offset produced flags nflags copy_count copy_disp window')
+
+class SeekIndex:
+    """Checkpoints of the decompressor's state through an LZ10 or LZ11
+    stream, for reading parts of the output without decompressing all of
+    it.
+
+    There is a checkpoint every interval bytes of output, with where it is
+    in the compressed data and the last 4 KB of output before it. read()
+    starts from the nearest checkpoint, so it decompresses less than
+    interval bytes more than it returns. Build the index once with build()
+    and keep it with save() and load().
+    """
+
+    magic = b'LZSI'
+    _header = "<4sBBLLL"
+    _checkpoint = "<LLBBLHH"
+
+    def __init__(self, format, size, interval, checkpoints):
+        self.format = format
+        self.size = size
+        self.interval = interval
+        self.checkpoints = checkpoints
+
+    @classmethod
+    def build(cls, data, interval=0x10000):
+        """Decompresses data once, taking a checkpoint every interval bytes
+        of output."""
+        decompressor = LZDecompressor()
+        decompressor.decompress(bytes(data[:4]), 0)
+        if decompressor._size is None:
+            raise DecompressionError("not as lzss-compressed file")
+        pos = 4
+
+        checkpoints = []
+        while not decompressor.eof:
+            checkpoints.append(Checkpoint(
+                pos - len(decompressor._buf), decompressor._produced,
+                decompressor._flags, decompressor._nflags,
+                decompressor._copy_count, decompressor._copy_disp,
+                bytes(decompressor._window)))
+            pos = _decompress_some(decompressor, data, pos, interval)[1]
+
+        return cls(data[0], decompressor._size, interval, checkpoints)
+
+    def read(self, data, offset, length):
+        """Returns length bytes of the output of data, starting at offset.
+        data has to be the stream the index was built from."""
+        if bytes(data[:4]) != pack("<L", (self.size << 8) | self.format):
+            raise ValueError("the index doesn't match this data")
+        if offset < 0:
+            raise ValueError("negative offset: {}".format(offset))
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return bytearray()
+
+        checkpoint = self.checkpoints[min(offset // self.interval,
+                                          len(self.checkpoints) - 1)]
+        decompressor = LZDecompressor()
+        decompressor._lz11 = self.format == 0x11
+        decompressor._size = self.size
+        decompressor._produced = checkpoint.produced
+        decompressor._flags = checkpoint.flags
+        decompressor._nflags = checkpoint.nflags
+        decompressor._copy_count = checkpoint.copy_count
+        decompressor._copy_disp = checkpoint.copy_disp
+        decompressor._window = bytearray(checkpoint.window)
+
+        skip = offset - checkpoint.produced
+        out = _decompress_some(decompressor, data, checkpoint.offset, skip + length)[0]
+        del out[:skip]
+        return out
+
+    def save(self, f):
+        f.write(pack(self._header, self.magic, 1, self.format, self.size,
+                     self.interval, len(self.checkpoints)))
+        for c in self.checkpoints:
+            f.write(pack(self._checkpoint, c.offset, c.produced, c.flags,
+                         c.nflags, c.copy_count, c.copy_disp, len(c.window)))
+            f.write(c.window)
+
+    @classmethod
+    def load(cls, f):
+        header = f.read(calcsize(cls._header))
+        if len(header) < calcsize(cls._header) or not header.startswith(cls.magic):
+            raise ValueError("not a seek index")
+        _, version, format, size, interval, count = unpack(cls._header, header)
+        if version != 1:
+            raise ValueError("unknown seek index version: {}".format(version))
+
+        checkpoints = []
+        for _ in range(count):
+            fields = unpack(cls._checkpoint, f.read(calcsize(cls._checkpoint)))
+            window = f.read(fields[-1])
+            checkpoints.append(Checkpoint(*fields[:-1], window))
+        return cls(format, size, interval, checkpoints)
+
+def _batch_inputs(paths, outdir):
+    """Returns a list of (input path, output path) for each file in paths.
+    Directories are walked, and their files keep their paths relative to
+    the directory under outdir. Raises ValueError if two inputs would be
+    written to the same output."""
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    inpath = os.path.join(root, name)
+                    inputs.append((inpath, os.path.join(outdir, os.path.relpath(inpath, path))))
+        else:
+            inputs.append((path, os.path.join(outdir, os.path.basename(path))))
+
+    seen = {}
+    for inpath, outpath in inputs:
+        key = os.path.normcase(os.path.abspath(outpath))
+        if key in seen:
+            raise ValueError("{} and {} would both be written to {}"
+                             .format(seen[key], inpath, outpath))
+        seen[key] = inpath
+    return inputs
+
+def _batch_one(inpath, outpath, overlay=False):
+    """Decompresses one file for decompress_batch(). Returns (input path,
+    status, input size, output size, message), where status is 'ok',
+    'skipped' or 'failed'."""
+    try:
+        with open(inpath, "rb") as f:
+            insize = os.fstat(f.fileno()).st_size
+            if not overlay:
+                header = f.read(1)
+                if not header or header[0] not in (0x10, 0x11):
+                    return (inpath, 'skipped', insize, 0,
+                            "not an lzss-compressed file")
+                f.seek(0)
+
+            if os.path.exists(outpath) and os.path.samefile(inpath, outpath):
+                return (inpath, 'failed', insize, 0,
+                        "output would overwrite the input")
+
+            # decompress next to the output and only replace it once that's
+            # worked, so a failure never leaves a partial file behind
+            os.makedirs(os.path.dirname(outpath) or '.', exist_ok=True)
+            tmp = "{}.{}.tmp".format(outpath, os.getpid())
+            try:
+                with open(tmp, "w+b") as out:
+                    if overlay:
+                        decompress_overlay(f, out)
+                        outsize = out.tell()
+                    else:
+                        outsize = decompress_to_file(f, out)
+                os.replace(tmp, outpath)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+    except (IOError, DecompressionError) as e:
+        return inpath, 'failed', 0, 0, str(e) or type(e).__name__
+
+    return inpath, 'ok', insize, outsize, None
+
+def decompress_batch(paths, outdir, jobs=None, overlay=False):
+    """Decompress many files, and the files in any directories, into outdir,
+    using a pool of jobs processes (by default, one per CPU).
+
+    Returns a list of (input path, status, input size, output size,
+    message) tuples, as from _batch_one(), in the order of the inputs.
+    Raises ValueError, before decompressing anything, if two inputs would
+    be written to the same output.
+    """
+    inputs = _batch_inputs(paths, outdir)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if jobs <= 1 or len(inputs) <= 1:
+        return [_batch_one(inpath, outpath, overlay)
+                for inpath, outpath in inputs]
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_batch_one, inpath, outpath, overlay)
+                   for inpath, outpath in inputs]
+        return [future.result() for future in futures]
+
+def batch_main(args, overlay=False):
+    """The command line for decompress_batch(). args are what's left after
+    --overlay."""
+    usage = "usage: lzss3.py [--overlay] -o OUTDIR [-j JOBS] FILE|DIR..."
+    outdir = None
+    jobs = None
+    paths = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-o', '--output-dir', '-j', '--jobs'):
+            if not args:
+                print(usage, file=stderr)
+                return 2
+            value = args.pop(0)
+            if arg in ('-o', '--output-dir'):
+                outdir = value
+            else:
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    print(usage, file=stderr)
+                    return 2
+        else:
+            paths.append(arg)
+
+    if outdir is None or not paths:
+        print(usage, file=stderr)
+        return 2
+
+    start = time.perf_counter()
+    try:
+        results = decompress_batch(paths, outdir, jobs, overlay)
+    except ValueError as e:
+        print(e, file=stderr)
+        return 2
+    elapsed = time.perf_counter() - start
+
+    total_in = total_out = done = skipped = failed = 0
+    for inpath, status, insize, outsize, message in results:
+        if status == 'ok':
+            done += 1
+            total_in += insize
+            total_out += outsize
+        elif status == 'skipped':
+            skipped += 1
+            print("{}: skipped: {}".format(inpath, message), file=stderr)
+        else:
+            failed += 1
+            print("{}: {}".format(inpath, message), file=stderr)
+
+    print("{} decompressed, {} skipped, {} failed; "
+          "{:.1f} MB in, {:.1f} MB out in {:.2f}s ({:.1f} MB/s out)"
+          .format(done, skipped, failed, total_in / 1e6, total_out / 1e6,
+                  elapsed, total_out / 1e6 / elapsed if elapsed else 0.0),
+          file=stderr)
+
+    return 1 if failed else 0
+
+OverlayEntry = namedtuple('OverlayEntry',
+    'id ram_address ram_size bss_size sinit_start sinit_end file_id size compressed')
+
+def read_overlay_table(data):
+    """Parses an overlay table, as found in y9.bin and y7.bin. Returns a list
+    of OverlayEntry."""
+    entries = []
+    for offset in range(0, len(data) - 31, 32):
+        fields = unpack_from("<8L", data, offset)
+        flags = fields[7]
+        entries.append(OverlayEntry(*fields[:7],
+                                    size=flags & 0xFFFFFF,
+                                    compressed=bool(flags >> 24 & 1)))
+    return entries
+
+def read_rom_overlays(m, arm7=False):
+    """Reads the ARM9 (or ARM7) overlay table of a DS ROM in memory. Returns a
+    list of (OverlayEntry, start, end), where start and end are the
+    overlay's file offsets in the ROM."""
+    if len(m) < 0x60:
+        raise DecompressionError("file is too short to be a DS ROM")
+    fat_offset, fat_size = unpack_from("<LL", m, 0x48)
+    table_offset, table_size = unpack_from("<LL", m, 0x58 if arm7 else 0x50)
+    if len(m) < fat_offset + fat_size or len(m) < table_offset + table_size:
+        raise DecompressionError("the FAT or overlay table runs past the end of the ROM")
+
+    overlays = []
+    for entry in read_overlay_table(m[table_offset:table_offset+table_size]):
+        if fat_size < (entry.file_id + 1) * 8:
+            raise DecompressionError("overlay {} has file id {} outside the FAT"
+                                     .format(entry.id, entry.file_id))
+        start, end = unpack_from("<LL", m, fat_offset + entry.file_id * 8)
+        if not start <= end <= len(m):
+            raise DecompressionError("overlay {} runs past the end of the ROM"
+                                     .format(entry.id))
+        overlays.append((entry, start, end))
+    return overlays
+
+def _extract_overlay(rompath, start, end, compressed, outpath=None):
+    """Extracts the overlay at rom[start:end], decompressing it if it's
+    compressed. Writes it to outpath, or returns it if outpath is None."""
+    with open(rompath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if compressed:
+                prefix, data = _decode_overlay(m, start, end)
+                parts = (m[start:start+prefix], data)
+            else:
+                parts = (m[start:end],)
+
+    # only create the file once there's something to put in it
+    if outpath is None:
+        return b''.join(parts)
+    with open(outpath, "wb") as out:
+        for part in parts:
+            out.write(part)
+    return outpath
+
+def extract_overlays(rompath, outdir=None, arm7=False, jobs=None):
+    """Extracts all the ARM9 (or ARM7) overlays from a DS ROM, decompressing
+    the ones flagged as compressed in the overlay table, across a pool of
+    jobs processes (by default, one per CPU).
+
+    If outdir is given, the overlays are written to overlay_NNNN.bin (or
+    overlay7_NNNN.bin) in it and a dict of overlay id -> path is returned.
+    Otherwise a dict of overlay id -> bytes is returned.
+    """
+    with open(rompath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            overlays = read_rom_overlays(m, arm7)
+
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+        name = "overlay7_{:04d}.bin" if arm7 else "overlay_{:04d}.bin"
+
+    tasks = []
+    for entry, start, end in overlays:
+        outpath = None
+        if outdir is not None:
+            outpath = os.path.join(outdir, name.format(entry.id))
+        tasks.append((entry.id, (rompath, start, end, entry.compressed, outpath)))
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(tasks) <= 1:
+        return {overlay_id: _extract_overlay(*args) for overlay_id, args in tasks}
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [(overlay_id, executor.submit(_extract_overlay, *args))
+                   for overlay_id, args in tasks]
+        return {overlay_id: future.result() for overlay_id, future in futures}
+
+def rom_main(args):
+    """The command line for extract_overlays()."""
+    usage = "usage: lzss3.py --rom ROM -o OUTDIR [-j JOBS] [--arm7]"
+    rompath = outdir = jobs = None
+    arm7 = False
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--arm7':
+            arm7 = True
+        elif arg in ('--rom', '-o', '--output-dir', '-j', '--jobs') and args:
+            value = args.pop(0)
+            if arg == '--rom':
+                rompath = value
+            elif arg in ('-o', '--output-dir'):
+                outdir = value
+            else:
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    print(usage, file=stderr)
+                    return 2
+        else:
+            print(usage, file=stderr)
+            return 2
+
+    if rompath is None or outdir is None:
+        print(usage, file=stderr)
+        return 2
+
+    start = time.perf_counter()
+    try:
+        paths = extract_overlays(rompath, outdir, arm7, jobs)
+    except (IOError, DecompressionError) as e:
+        print(e, file=stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    total = sum(os.path.getsize(path) for path in paths.values())
+    print("{} overlays, {:.1f} MB in {:.2f}s".format(len(paths), total / 1e6, elapsed),
+          file=stderr)
+    return 0
 
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
+    if '--rom' in args:
+        return rom_main(args)
+
     if '--overlay' in args:
         args.remove('--overlay')
         overlay = True
     else:
         overlay = False
 
+    if any(arg in ('-o', '--output-dir') for arg in args):
+        return batch_main(args, overlay)
+
     if len(args) < 1 or args[0] == '-':
         if overlay:
             print("Can't decompress overlays from stdin", file=stderr)
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 
 from lzss3 import (decompress_raw_lzss10, decompress_raw_lzss11,
-                   decompress_overlay, decompress)
-from compress import _compress, compress, compress_nlz11, NLZ11Window
+                   decompress_overlay, decompress, decompress_into,
+                   get_decompressed_size, decompress_to_file, decompress_batch,
+                   extract_overlays, LZDecompressor, DecompressionCache,
+                   AsyncDecompressor, SeekIndex, decompress_bytes,
+                   DecompressionError)
+from compress import (_compress, compress, compress_nlz11, NLZ11Window,
+                      NLZ11TreeWindow, LZCompressor, compress_stream,
+                      compress_overlay, MatchStats, _tokenize,
+                      NLZ10IndexWindow, NLZ11IndexWindow, CompressionCache,
+                      _tokenize_parallel, estimate_sizes, compress_auto)
 
+import os
+import random
 from io import BytesIO
+from struct import pack, unpack
+
+import pytest
 
 def test_lzss10():
     assert decompress_raw_lzss10(b'\x00', 0) == b''
@@ -18,12 +31,320 @@ def test_lzss11():
     assert decompress_raw_lzss11(b'\x08abcd\x01\x30\x03', 40) == b'abcd' * 10
     assert decompress_raw_lzss11(b'\x08abcd\x10\x07\xb0\x03', 400) == b'abcd' * 100
 
+def test_decompress_errors():
+    with pytest.raises(DecompressionError):
+        decompress_raw_lzss10(b'\x00abcd', 8)
+    with pytest.raises(DecompressionError):
+        decompress_raw_lzss10(b'\x08abcd\xd0', 20)
+    with pytest.raises(DecompressionError):
+        decompress_raw_lzss10(b'\x08abcd\xd0\x04', 20)
+    with pytest.raises(DecompressionError):
+        decompress_raw_lzss11(b'\x08abcd\xf0\x03', 16)
+    with pytest.raises(DecompressionError):
+        decompress_raw_lzss11(b'\x08abcd\x10\x07', 400)
+    for data in (b'', b'\x10\x00', b'\x11\x00\x00'):
+        with pytest.raises(DecompressionError):
+            decompress_bytes(data)
+        with pytest.raises(DecompressionError):
+            get_decompressed_size(data)
+
+def test_decompress_into():
+    data = b'\x11\x14\x00\x00\x08abcd\xf0\x03'
+    assert get_decompressed_size(data) == 20
+
+    buf = bytearray(b'-' * 24)
+    assert decompress_into(data, buf, 2) == 20
+    assert buf == b'--' + b'abcd' * 5 + b'--'
+
+    buf = bytearray(20)
+    decompress_into(memoryview(b'xx' + data)[2:], memoryview(buf))
+    assert buf == b'abcd' * 5
+
+    with pytest.raises(ValueError):
+        decompress_into(data, bytearray(21), 2)
+
+def test_decompressor():
+    data = b'\x11\x90\x01\x00\x08abcd\x10\x07\xb0\x03\xff\xff'
+    d = LZDecompressor()
+    out = b''
+    i = 0
+    while not d.eof:
+        out += d.decompress(data[i:i+1], 50)
+        i += 1
+        while not d.needs_input and not d.eof:
+            out += d.decompress(b'', 50)
+    assert out == b'abcd' * 100
+    assert d.eof
+    assert d.unused_data == b''
+
+    d = LZDecompressor()
+    assert d.decompress(data[:9]) == b'abcd'
+    assert d.needs_input
+    with pytest.raises(DecompressionError):
+        d.flush()
+
+def test_decompression_cache(tmp_path):
+    blobs = []
+    for i in range(4):
+        out = BytesIO()
+        compress_nlz11(bytes([i]) * 1000, out)
+        blobs.append(out.getvalue())
+
+    cache = DecompressionCache(max_size=2500)
+    first = cache.decompress_bytes(blobs[0])
+    assert first == b'\x00' * 1000 and type(first) is bytes
+    assert cache.decompress_bytes(bytearray(blobs[0])) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    path = tmp_path / 'blob.lz'
+    path.write_bytes(blobs[0])
+    with open(str(path), 'rb') as f:
+        assert cache.decompress_file(f) is first
+        assert f.read() == b''
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # the least recently used result goes first
+    cache.decompress_bytes(blobs[1])
+    cache.decompress_bytes(blobs[0])
+    cache.decompress_bytes(blobs[2])
+    assert len(cache) == 2 and cache.size == 2000
+    assert cache.decompress_bytes(blobs[0]) is first
+    assert (cache.hits, cache.misses) == (4, 3)
+
+    with pytest.raises(DecompressionError):
+        cache.decompress_bytes(blobs[3][:6])
+
+def test_async_decompressor():
+    import asyncio
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    class Executor(ThreadPoolExecutor):
+        def __init__(self):
+            ThreadPoolExecutor.__init__(self, max_workers=8)
+            self.lock = threading.Lock()
+            self.running = self.most = self.calls = 0
+
+        def submit(self, fn, *args):
+            def run():
+                with self.lock:
+                    self.calls += 1
+                    self.running += 1
+                    self.most = max(self.most, self.running)
+                time.sleep(0.02)
+                try:
+                    return fn(*args)
+                finally:
+                    with self.lock:
+                        self.running -= 1
+            return ThreadPoolExecutor.submit(self, run)
+
+    small = b'small' * 10
+    large = random.Random(3).randbytes(10000)
+    blobs = []
+    for indata in (small, large):
+        out = BytesIO()
+        compress_nlz11(indata, out)
+        blobs.append(out.getvalue())
+
+    async def main(executor):
+        decompressor = AsyncDecompressor(executor, max_concurrency=2, inline_size=1000)
+        assert await decompressor.decompress(blobs[0]) == small
+        assert executor.calls == 0
+
+        results = await asyncio.gather(*[decompressor.decompress(blobs[1]) for _ in range(5)])
+        assert results == [large] * 5
+        assert executor.calls == 5 and executor.most == 2
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(blobs[1])
+        reader.feed_eof()
+        assert await decompressor.decompress(reader) == large
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'\x42' * 10)
+        with pytest.raises(DecompressionError):
+            await decompressor.decompress(reader)
+
+    with Executor() as executor:
+        asyncio.run(main(executor))
+
+def test_seek_index():
+    rng = random.Random(4)
+    indata = b''.join(rng.choice([rng.randbytes(300), b'\x00' * rng.randrange(1, 5000),
+                                  b'abc' * 500]) for _ in range(50))
+    for func in (compress, compress_nlz11):
+        out = BytesIO()
+        func(indata, out)
+        data = out.getvalue()
+
+        assert decompress_bytes(data, 100) == indata[:100]
+        assert decompress_bytes(data, len(indata) + 1) == indata
+        with pytest.raises(DecompressionError):
+            decompress_bytes(data[:50], len(indata))
+
+        index = SeekIndex.build(data, interval=1000)
+        assert len(index.checkpoints) == -(-len(indata) // 1000)
+        f = BytesIO()
+        index.save(f)
+        f.seek(0)
+        index = SeekIndex.load(f)
+
+        for offset, length in [(0, 10), (999, 2), (1000, 0), (4321, 5000),
+                               (len(indata) - 3, 10), (len(indata) + 5, 10)]:
+            assert index.read(data, offset, length) == indata[offset:offset+length]
+        assert index.read(memoryview(data), 2500, 10) == indata[2500:2510]
+
+        with pytest.raises(ValueError):
+            index.read(b'\x11\x00\x00\x00', 0, 10)
+        with pytest.raises(ValueError):
+            index.read(data, -5, 10)
+    with pytest.raises(ValueError):
+        SeekIndex.load(BytesIO(b'junk'))
+
 def test_overlay():
     in_ = BytesIO(b'\x01\xd0abcd\x08\xff\x10\x00\x00\x09\x04\x00\x00\x00')
     out = BytesIO()
     decompress_overlay(in_, out)
     assert out.getvalue() == b'abcd' * 5
 
+    # a footer claiming far more output than its data could hold
+    in_ = BytesIO(b'\x01\xd0abcd\x08\xff\x10\x00\x00\x09\x00\x00\x00\x40')
+    with pytest.raises(DecompressionError):
+        decompress_overlay(in_, BytesIO())
+
+def test_mapped_files(tmp_path):
+    path = tmp_path / "in.bin"
+    path.write_bytes(b'junk\x11\x14\x00\x00\x08abcd\xf0\x03')
+    with open(path, "rb") as f:
+        f.read(4)
+        assert decompress(f) == b'abcd' * 5
+
+    with open(path, "rb") as f, open(tmp_path / "out.bin", "w+b") as out:
+        f.read(4)
+        out.write(b'<')
+        assert decompress_to_file(f, out) == 20
+        out.write(b'>')
+    assert (tmp_path / "out.bin").read_bytes() == b'<' + b'abcd' * 5 + b'>'
+
+    # files that can't be mapped get the output written to them
+    for mode in ("ab", "wb"):
+        (tmp_path / "out.bin").write_bytes(b'PRE')
+        with open(path, "rb") as f, open(tmp_path / "out.bin", mode) as out:
+            f.read(4)
+            if mode == "wb":
+                out.write(b'PRE')
+            assert decompress_to_file(f, out) == 20
+        assert (tmp_path / "out.bin").read_bytes() == b'PRE' + b'abcd' * 5
+
+    r, w = os.pipe()
+    with open(path, "rb") as f, open(r, "rb") as pipe_in, open(w, "wb") as pipe_out:
+        f.read(4)
+        assert decompress_to_file(f, pipe_out) == 20
+        pipe_out.close()
+        assert pipe_in.read() == b'abcd' * 5
+
+    path = tmp_path / "overlay.bin"
+    path.write_bytes(b'head\x01\xd0abcd\x08\xff\x10\x00\x00\x09\x04\x00\x00\x00')
+    out = BytesIO()
+    with open(path, "rb") as f:
+        decompress_overlay(f, out)
+    assert out.getvalue() == b'head' + b'abcd' * 5
+
+def test_batch(tmp_path):
+    (tmp_path / "in" / "sub").mkdir(parents=True)
+    (tmp_path / "in" / "a.bin").write_bytes(b'\x10\x08\x00\x00\x00abcdefgh')
+    (tmp_path / "in" / "sub" / "b.bin").write_bytes(b'\x11\x14\x00\x00\x08abcd\xf0\x03')
+    (tmp_path / "in" / "c.txt").write_bytes(b'not compressed')
+    (tmp_path / "in" / "d.bin").write_bytes(b'\x10\x08\x00\x00\x00abc')
+    (tmp_path / "in" / "e.bin").write_bytes(b'\x10\x00')
+
+    results = decompress_batch([str(tmp_path / "in")], str(tmp_path / "out"), jobs=2)
+    assert [r[1] for r in results] == ['ok', 'skipped', 'failed', 'failed', 'ok']
+    assert (tmp_path / "out" / "a.bin").read_bytes() == b'abcdefgh'
+    assert (tmp_path / "out" / "sub" / "b.bin").read_bytes() == b'abcd' * 5
+    assert not (tmp_path / "out" / "d.bin").exists()
+    assert not list((tmp_path / "out").glob("*.tmp"))
+
+    # decompressing into the input's own directory mustn't touch it
+    # (big enough not to be read in one go)
+    out = BytesIO()
+    compress(random.Random(0).randbytes(100000), out)
+    big = out.getvalue()
+    (tmp_path / "in" / "big.bin").write_bytes(big)
+    results = decompress_batch([str(tmp_path / "in" / "big.bin")], str(tmp_path / "in"))
+    assert results[0][1] == 'failed'
+    assert (tmp_path / "in" / "big.bin").read_bytes() == big
+
+    # a failure leaves whatever was at the output alone
+    (tmp_path / "out" / "d.bin").write_bytes(b'old')
+    results = decompress_batch([str(tmp_path / "in" / "d.bin")], str(tmp_path / "out"))
+    assert results[0][1] == 'failed'
+    assert (tmp_path / "out" / "d.bin").read_bytes() == b'old'
+
+    (tmp_path / "in2").mkdir()
+    (tmp_path / "in2" / "a.bin").write_bytes(b'\x10\x08\x00\x00\x00abcdefgh')
+    with pytest.raises(ValueError):
+        decompress_batch([str(tmp_path / "in" / "a.bin"), str(tmp_path / "in2" / "a.bin")],
+                         str(tmp_path / "out2"), jobs=2)
+    assert not (tmp_path / "out2").exists()
+
+def make_rom(files, overlays):
+    """Builds a minimal DS ROM with the given files and ARM9 overlay table,
+    a list of (file id, compressed) pairs."""
+    fat_offset = 0x200
+    table_offset = fat_offset + 8 * len(files)
+    data_offset = table_offset + 32 * len(overlays)
+
+    header = bytearray(0x200)
+    header[0x48:0x50] = pack("<LL", fat_offset, 8 * len(files))
+    header[0x50:0x58] = pack("<LL", table_offset, 32 * len(overlays))
+
+    fat = b''
+    offset = data_offset
+    for f in files:
+        fat += pack("<LL", offset, offset + len(f))
+        offset += len(f)
+
+    table = b''
+    for i, (file_id, compressed) in enumerate(overlays):
+        flags = (compressed << 24) | len(files[file_id])
+        table += pack("<8L", i, 0x02000000, 0, 0, 0, 0, file_id, flags)
+
+    return bytes(header) + fat + table + b''.join(files)
+
+def test_extract_overlays(tmp_path):
+    overlay = b'\x01\xd0abcd\x08\xff\x10\x00\x00\x09\x04\x00\x00\x00'
+    rom = tmp_path / "rom.nds"
+    rom.write_bytes(make_rom([b'arm9', b'head' + overlay, b'plain'],
+                             [(1, True), (2, False)]))
+
+    assert extract_overlays(str(rom), jobs=1) == \
+        {0: b'head' + b'abcd' * 5, 1: b'plain'}
+
+    paths = extract_overlays(str(rom), str(tmp_path / "out"), jobs=2)
+    with open(paths[0], "rb") as f:
+        assert f.read() == b'head' + b'abcd' * 5
+    with open(paths[1], "rb") as f:
+        assert f.read() == b'plain'
+
+    # the last file is cut short
+    rom.write_bytes(make_rom([b'arm9', b'head' + overlay, b'plain'],
+                             [(1, True), (2, False)])[:-2])
+    with pytest.raises(DecompressionError):
+        extract_overlays(str(rom), str(tmp_path / "bad"), jobs=1)
+    rom.write_bytes(b'\x00' * 0x40)
+    with pytest.raises(DecompressionError):
+        extract_overlays(str(rom), str(tmp_path / "bad"), jobs=1)
+
+    # an overlay that doesn't decompress leaves no file behind
+    bogus = overlay[:-4] + b'\x00\x00\x00\x40'
+    rom.write_bytes(make_rom([b'arm9', bogus], [(1, True)]))
+    with pytest.raises(DecompressionError):
+        extract_overlays(str(rom), str(tmp_path / "bad"), jobs=1)
+    assert not list((tmp_path / "bad").iterdir())
+
 def test_compress():
     assert list(_compress(b'abcdabcd')) == [97, 98, 99, 100, (4, -4)]
     assert list(_compress(b'xaaabaaaaa')) == [120, 97, 97, 97, 98, (3, -4), 97, 97]
@@ -33,11 +354,15 @@ def test_compress():
 
     #print( list(_compress(b'abcdefg' * 10)) )
     assert list(_compress(b'abcdefg' * 10)) == \
-        [97, 98, 99, 100, 101, 102, 103, (18, -7), (18, -21), (18, -42), (9, -56)]
+        [97, 98, 99, 100, 101, 102, 103, (18, -7), (18, -7), (18, -7), (9, -7)]
 
     assert list(_compress(b'abcdefg' * 10, NLZ11Window)) == \
         [97, 98, 99, 100, 101, 102, 103, (63, -7)]
 
+    # overlapping matches
+    assert list(_compress(b'a' * 40)) == [97, 97, (18, -2), (18, -2), 97, 97]
+    assert list(_compress(b'ab' * 300, NLZ11Window)) == [97, 98, (598, -2)]
+
     out = BytesIO()
     compress_nlz11(b'abcdefg' * 10, out)
     assert out.getvalue()[12:15] == b'\x02\xe0\x06'
@@ -64,9 +389,369 @@ def test_roundtrip():
     decompressed_data = decompress(out.getvalue())
     assert indata == decompressed_data
 
+def test_compress_tree():
+    assert list(_compress(b'abcdefg' * 10, NLZ11TreeWindow)) == \
+        [97, 98, 99, 100, 101, 102, 103, (63, -7)]
+    assert list(_compress(b'xaaabaaaaa', NLZ11TreeWindow)) == \
+        [120, 97, 97, 97, 98, (3, -4), 97, 97]
+
+    indata = b'\x00' * 5000 + b'abc' * 1000 + b'\x00' * 70000
+    out = BytesIO()
+    compress_nlz11(indata, out, windowclass=NLZ11TreeWindow)
+    tree_compressed = out.getvalue()
+    assert decompress(tree_compressed) == indata
+
+    out = BytesIO()
+    compress_nlz11(indata, out)
+    assert len(tree_compressed) == len(out.getvalue())
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_compress_index(monkeypatch, use_numpy):
+    import compress as module
+    if not use_numpy:
+        monkeypatch.setattr(module, 'numpy', None)
+
+    rng = random.Random(1)
+    indata = (b'\x00' * 5000 + bytes(rng.choice(b'abc') for _ in range(20000)) +
+              b'xyz' * 1000 + rng.randbytes(3000))
+    for func, windowclass in ((compress, NLZ10IndexWindow),
+                              (compress_nlz11, NLZ11IndexWindow)):
+        out = BytesIO()
+        func(indata, out, windowclass)
+        indexed = out.getvalue()
+        out = BytesIO()
+        func(indata, out)
+        assert indexed == out.getvalue()
+
+    assert list(_compress(b'ab', NLZ11IndexWindow)) == [97, 98]
+    with pytest.raises(ValueError):
+        LZCompressor(0x11, windowclass=NLZ11IndexWindow)
+
+def test_compress_parallel():
+    rng = random.Random(2)
+    indata = (bytes(rng.choice(b'abcd') for _ in range(9000)) + b'\x00' * 20000 +
+              b'xyz' * 3000 + rng.randbytes(2000))
+    for windowclass in (NLZ11Window, NLZ11TreeWindow):
+        tokens = _tokenize(indata, windowclass)
+        parallel = _tokenize_parallel(indata, windowclass, jobs=2, segment_size=5000)
+        assert parallel.counts == tokens.counts
+        assert parallel.values == tokens.values
+
+    for func in (compress, compress_nlz11):
+        out = BytesIO()
+        func(indata, out)
+        parallel = BytesIO()
+        func(indata, parallel, jobs=2)
+        assert parallel.getvalue() == out.getvalue()
+
+    with pytest.raises(ValueError):
+        compress_nlz11(indata, BytesIO(), stats=MatchStats(), jobs=2)
+
+def test_compressor():
+    with open("lzss3.py", "rb") as f:
+        indata = f.read()
+    indata = indata + bytes(70000) + indata
+
+    for format, compress_func in ((0x10, compress), (0x11, compress_nlz11)):
+        out = BytesIO()
+        compress_func(indata, out)
+        expected = out.getvalue()
+
+        c = LZCompressor(format, size=len(indata))
+        c.discard_windows = 1
+        chunks = [c.compress(indata[i:i+1000])
+                  for i in range(0, len(indata), 1000)]
+        chunks.append(c.flush())
+        assert b''.join(chunks) == expected
+
+        out = BytesIO()
+        compress_stream(BytesIO(indata), out, format)
+        assert out.getvalue() == expected
+
+    class Unseekable(BytesIO):
+        def seekable(self):
+            return False
+
+    with pytest.raises(ValueError):
+        compress_stream(BytesIO(indata), Unseekable())
+
+def decompress_in_place(data):
+    """Decompresses an overlay the way the DS does, in place, and checks
+    that no input is overwritten before it's read."""
+    buf = bytearray(data)
+    end_delta, start_delta = unpack("<LL", buf[-8:])
+    padding = end_delta >> 24
+    end_delta &= 0xFFFFFF
+
+    stop = len(buf) - end_delta
+    r = len(buf) - padding
+    w = len(buf) + start_delta
+    buf.extend(bytes(start_delta))
+
+    def readbyte():
+        nonlocal r
+        r -= 1
+        return buf[r]
+
+    while stop < w:
+        flags = readbyte()
+        for bit in range(8):
+            if w <= stop:
+                break
+            if flags & (0x80 >> bit):
+                sh = (readbyte() << 8) | readbyte()
+                count = (sh >> 12) + 3
+                disp = (sh & 0xFFF) + 3
+                for _ in range(count):
+                    w -= 1
+                    assert r <= w
+                    buf[w] = buf[w + disp]
+            else:
+                b = readbyte()
+                w -= 1
+                assert r <= w
+                buf[w] = b
+
+    assert r == w == stop
+    return bytes(buf)
+
+def test_compression_cache(tmp_path, monkeypatch):
+    import compress as module
+    cache = CompressionCache(str(tmp_path), max_size=1000)
+    inputs = [bytes([i]) * 2000 + b'abc' * i for i in range(5)]
+    expected = {}
+    for format, func in ((0x10, compress), (0x11, compress_nlz11),
+                         ('overlay', compress_overlay)):
+        for indata in inputs:
+            out = BytesIO()
+            func(indata, out)
+            expected[format, indata] = out.getvalue()
+
+    for format in (0x10, 0x11, 'overlay'):
+        assert cache.compress(inputs[0], format) == expected[format, inputs[0]]
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert len({cache.key(inputs[0], 0x11), cache.key(inputs[0], 0x11, NLZ11TreeWindow),
+                cache.key(inputs[0], 0x10), cache.key(inputs[1], 0x11)}) == 4
+    # the same class, as seen from python compress.py
+    script_window = type('NLZ11Window', (NLZ11Window,), {'__module__': '__main__'})
+    assert cache.key(inputs[0], 0x11, script_window) == cache.key(inputs[0], 0x11)
+
+    def fail(*args):
+        raise AssertionError("compressed a cached input")
+    monkeypatch.setattr(module, '_tokenize', fail)
+    for format in (0x10, 0x11, 'overlay'):
+        assert cache.compress(inputs[0], format) == expected[format, inputs[0]]
+    assert (cache.hits, cache.misses) == (3, 3)
+    monkeypatch.undo()
+
+    # each entry is about 100 bytes; the oldest ones go first
+    for indata in inputs[1:]:
+        for format in (0x10, 0x11, 'overlay'):
+            cache.compress(indata, format)
+    size = sum(f.stat().st_size for f in tmp_path.glob('*/*'))
+    assert 0 < size <= 1000
+    assert cache.get(cache.key(inputs[0], 0x10)) is None
+    assert cache.get(cache.key(inputs[4], 0x11)) == expected[0x11, inputs[4]]
+
+def test_compress_auto():
+    rng = random.Random(9)
+    for indata in [b'', rng.randbytes(3000), b'\x00' * 20000,
+                   b''.join(rng.choice([rng.randbytes(40), b'ab' * 100])
+                            for _ in range(200))]:
+        sizes = []
+        for func in (compress, compress_nlz11):
+            out = BytesIO()
+            func(indata, out)
+            sizes.append(len(out.getvalue()))
+        estimate = estimate_sizes(indata, sample_size=0x800, samples=8)
+        assert estimate_sizes(indata, sample_size=0x800, samples=1).raw == len(indata)
+        assert estimate.raw == len(indata)
+        for guess, size in zip(estimate[1:], sizes):
+            assert abs(guess - size) <= size // 4 + 64
+
+        for refine in (False, True):
+            out = BytesIO()
+            format = compress_auto(indata, out, refine)
+            data = out.getvalue()
+            assert len(data) <= min(sizes + [len(indata)]) * 1.25
+            if format is None:
+                assert data == indata
+            else:
+                assert data[0] == format
+                assert decompress_bytes(data) == indata
+
+def test_compress_overlay():
+    with open("lzss3.py", "rb") as f:
+        text = f.read()
+    noise = random.Random(0).randbytes(3000)
+
+    for indata in (text, noise + text, text + noise, b'abcd' * 5):
+        out = BytesIO()
+        assert compress_overlay(indata, out)
+        compressed = out.getvalue()
+        assert len(compressed) < len(indata)
+        assert len(compressed) % 4 == 0
+
+        decompressed = BytesIO()
+        decompress_overlay(BytesIO(compressed), decompressed)
+        assert decompressed.getvalue() == indata
+        assert decompress_in_place(compressed) == indata
+
+    out = BytesIO()
+    assert not compress_overlay(noise, out)
+    assert out.getvalue() == noise
+
+def test_verify():
+    import verify
+    rng = random.Random(6)
+    indata = b''.join(rng.choice([rng.randbytes(100), b'\x00' * rng.randrange(1, 500),
+                                  b'abc' * 50]) for _ in range(30))
+    for func, format in ((compress, 'lz10'), (compress_nlz11, 'lz11')):
+        out = BytesIO()
+        func(indata, out)
+        data = out.getvalue()
+
+        report = verify.scan(data)
+        assert report.ok and report.error is None
+        assert report.format == format
+        assert report.decompressed_size == len(indata)
+        assert report.compressed_size + report.padding == len(data)
+        assert 0 < report.literals and 0 < report.matches
+        verify.verify_bytes(data)
+
+        report = verify.scan(data[:len(data) // 2])
+        assert not report.ok and report.error == "compressed data is truncated"
+        with pytest.raises(verify.VerificationError):
+            verify.verify_bytes(data[:len(data) // 2])
+        assert not verify.scan(data + bytes(4)).ok
+
+    # a reference to before the start of the output
+    report = verify.scan(b'\x10\x04\x00\x00\x40a\x00\x01')
+    assert not report.ok and report.error_offset == 6
+    assert (report.literals, report.matches) == (1, 0)
+    # a reference that runs past the end of the output
+    assert not verify.scan(b'\x10\x04\x00\x00\x40a\x10\x00').ok
+    assert verify.scan(b'\x10\x04\x00\x00\x40a\x00\x00').ok
+
+    out = BytesIO()
+    compress_overlay(indata, out)
+    data = out.getvalue()
+    report = verify.scan(data, overlay=True)
+    assert report.ok and report.format == 'overlay'
+    assert report.decompressed_size - report.compressed_size == len(indata) - len(data)
+    assert not verify.scan(data[:-8] + pack("<LL", 0x08000000 | len(data) + 1, 0), overlay=True).ok
+    assert not verify.scan(data[:-4] + pack("<L", unpack("<L", data[-4:])[0] + 1), overlay=True).ok
+    # a long match early on gets the output ahead of the input, so
+    # decompressing in place would overwrite the last flag byte
+    stream = b'\x10abc\xf0\x00defg\x00hijklmno'
+    data = stream[::-1] + pack("<LL", 0x08000000 | len(stream) + 8, 6)
+    report = verify.scan(data, overlay=True)
+    assert not report.ok and report.error_offset == 13
+    assert report.decompressed_size == 33
+
+def test_find_streams(tmp_path):
+    import verify
+    rng = random.Random(8)
+    blob = bytearray()
+    expected = []
+    for func, format in [(compress, 'lz10'), (compress_nlz11, 'lz11')] * 4:
+        blob += rng.choice([rng.randbytes(rng.randrange(1, 5000)), bytes(rng.randrange(1, 5000))])
+        indata = b''.join(rng.choice([rng.randbytes(50), b'\x00' * rng.randrange(1, 500),
+                                      b'abcd' * 30]) for _ in range(20))
+        out = BytesIO()
+        func(indata, out)
+        report = verify.scan(out.getvalue())
+        expected.append(verify.Stream(len(blob), format, report.compressed_size, len(indata)))
+        blob += out.getvalue()
+    blob += rng.randbytes(100)
+    path = tmp_path / "blob.bin"
+    path.write_bytes(blob)
+
+    # some of the shards end in the middle of a stream
+    assert verify.find_streams(str(path), jobs=1) == expected
+    assert verify.find_streams(str(path), jobs=2, shard_size=3000) == expected
+    assert verify.find_streams(str(path), jobs=1, min_size=len(blob)) == []
+
+    # An all-literal stream with another one's header among its literals,
+    # lined up so the second parses as a stream too and swallows the
+    # header of a real one after the first. When a shard starts between the
+    # two headers, its spurious hit mustn't hide the real stream.
+    literals = bytearray(rng.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(240))
+    literals[204:208] = pack("<L", 35 << 8 | 0x10)
+    outer = pack("<L", 240 << 8 | 0x10) + b''.join(
+        b'\x00' + literals[i:i+8] for i in range(0, 240, 8))
+    out = BytesIO()
+    compress(b'hello there ' * 10, out)
+    path.write_bytes(b'x' * 10 + outer + out.getvalue())
+    assert [s.offset for s in verify.find_streams(str(path), jobs=1, shard_size=200)] == \
+        [10, 10 + len(outer)]
+
+def test_tokens():
+    indata = b'xaaabaaaaa' + b'abcdefg' * 100
+    tokens = _tokenize(indata, NLZ11Window)
+    assert list(tokens) == list(_compress(indata, NLZ11Window))
+    assert tokens.counts[:6].tolist() == [0, 0, 0, 0, 0, 3]
+    assert tokens.values[:6].tolist() == [120, 97, 97, 97, 98, 4]
+    assert tokens.decompressed_size() == len(indata)
+
+    import verify
+    out = BytesIO()
+    compress_nlz11(indata, out)
+    parsed, positions = verify.lz11_tokens(out.getvalue()[4:], len(indata))
+    assert parsed.counts == tokens.counts
+    assert parsed.values == tokens.values
+    assert positions[:6].tolist() == [5, 6, 7, 8, 9, 10]
+    verify.verify_tokens(parsed, positions, len(indata))
+
+def test_match_stats():
+    indata = b'abcdefg' * 10 + bytes(range(20))
+    plain = BytesIO()
+    compress_nlz11(indata, plain)
+
+    for windowclass in (NLZ11Window, NLZ11TreeWindow):
+        stats = MatchStats()
+        out = BytesIO()
+        compress_nlz11(indata, out, windowclass, stats=stats)
+        assert out.getvalue() == plain.getvalue()
+        assert stats.literals == 27
+        assert stats.lengths == {63: 1}
+        assert stats.displacements == {7: 1}
+        assert stats.positions == 28
+        assert 0 < stats.candidates
+        assert 'matches:              1 ' in str(stats)
+
+    stats = MatchStats()
+    compress_overlay(indata, BytesIO(), stats=stats)
+    assert 0 < stats.matches
+    assert 0 < stats.compared
+
+def test_bench():
+    import bench
+    # 1001 isn't a whole number of flag groups
+    results = bench.run(sizes=(1000, 1001), repeat=1)
+    assert {r['corpus'] for r in results['results']} == set(bench.KINDS)
+    # the legacy decoders only get skipped
+    assert {r['codec'] for r in results['skipped']} <= {'verify.lz10', 'armdecomp3.lz10'}
+    assert bench.compare(results, results) == []
+
+    worse = {'results': [dict(r, mb_per_s=r['mb_per_s'] / 2, ratio=r['ratio'] + 0.1)
+                         for r in results['results'][:1]]}
+    assert len(bench.compare(results, worse)) == 2
+
 if __name__ == '__main__':
     test_lzss10()
     test_lzss11()
+    test_decompress_errors()
+    test_decompress_into()
+    test_decompressor()
     test_overlay()
     test_compress()
     test_roundtrip()
+    test_compress_tree()
+    test_compressor()
+    test_compress_auto()
+    test_compress_overlay()
+    test_verify()
+    test_tokens()
+    test_match_stats()
+    test_bench()
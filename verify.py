@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
+import mmap
+import time
 from sys import stdin, stdout, stderr, exit
 from os import SEEK_SET, SEEK_CUR, SEEK_END
 from errno import EPIPE
-from struct import pack, unpack
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from struct import pack, unpack, unpack_from
+
+from compress import Tokens
+from lzss3 import FLAG_RUNS
 
 class DecompressionError(ValueError):
     pass
@@ -74,50 +84,358 @@ def decompress_raw_lzss10(indata, decompressed_size, _overlay=False):
 
     return data
 
-def lz11_tokens(indata):
-    it = iter(indata)
-    i = 4
+def lz10_tokens(indata, decompressed_size):
+    """Parses LZ10-compressed data (after the header) like lz11_tokens()."""
+    tokens = Tokens()
+    counts = tokens.counts
+    values = tokens.values
+    positions = array('L')
 
-    def readbyte():
-        nonlocal i
+    end = len(indata)
+    i = 0
+    length = 0
+    while length < decompressed_size and i < end:
+        flags = indata[i]
         i += 1
-        return next(it)
+        for bit in range(7, -1, -1):
+            if decompressed_size <= length or end <= i:
+                break
+            positions.append(i + 4)
+            if not flags >> bit & 1:
+                counts.append(0)
+                values.append(indata[i])
+                i += 1
+                length += 1
+                continue
+
+            if end < i + 2:
+                break
+            sh = indata[i] << 8 | indata[i+1]
+            i += 2
+            counts.append((sh >> 12) + 3)
+            values.append((sh & 0xfff) + 1)
+            length += counts[-1]
+
+    del positions[len(counts):]
+    return tokens, positions
+
+def lz11_tokens(indata, decompressed_size):
+    """Parses LZ11-compressed data (after the header) up to
+    decompressed_size bytes of output.
+
+    Returns a compress.Tokens and an array with the offset of each token
+    in the file. A token's flag byte is just before the first token of its
+    group. Stops early if the data runs out."""
+    tokens = Tokens()
+    counts = tokens.counts
+    values = tokens.values
+    positions = array('L')
+
+    end = len(indata)
+    i = 0
+    length = 0
+    while length < decompressed_size and i < end:
+        flags = indata[i]
+        i += 1
+        for bit in range(7, -1, -1):
+            if decompressed_size <= length or end <= i:
+                break
+            positions.append(i + 4)
+            if not flags >> bit & 1:
+                counts.append(0)
+                values.append(indata[i])
+                i += 1
+                length += 1
+                continue
+
+            b = indata[i]
+            indicator = b >> 4
+            if indicator == 0:
+                # 8 bit count, 12 bit disp
+                size = 3
+                if end < i + size:
+                    break
+                count = (indata[i] << 4 | indata[i+1] >> 4) + 0x11
+            elif indicator == 1:
+                # 16 bit count, 12 bit disp
+                size = 4
+                if end < i + size:
+                    break
+                count = ((b & 0xf) << 12 | indata[i+1] << 4 | indata[i+2] >> 4) + 0x111
+            else:
+                # indicator is count (4 bits), 12 bit disp
+                size = 2
+                if end < i + size:
+                    break
+                count = indicator + 1
+
+            i += size
+            counts.append(count)
+            values.append(((indata[i-2] & 0xf) << 8 | indata[i-1]) + 1)
+            length += count
 
-    while True:
-        flagpos = i
-        flags = bits(readbyte())
-        for flag in flags:
-            pos = i
-            if flag == 0:
-                yield readbyte(), pos, flagpos
-            elif flag == 1:
-                b = readbyte()
-                indicator = b >> 4
+    del positions[len(counts):]
+    return tokens, positions
+
+# The result of scan(). format is 'lz10', 'lz11' or 'overlay'. error and
+# error_offset describe the first problem found, or are None. The counts
+# cover the tokens up to that point. compressed_size is how much of the
+# data the stream takes up, including the header (or, for an overlay, the
+# compressed part at the end with its footer); padding is how many bytes
+# follow it.
+Report = namedtuple('Report', 'format ok error error_offset literals matches '
+                              'compressed_size decompressed_size padding')
+
+class _Failure(Exception):
+    pass
+
+def scan(data, overlay=False, max_padding=3):
+    """Checks LZ10, LZ11 or (if overlay is true) overlay-compressed bytes
+    without decompressing them. Returns a Report.
+
+    A stream passes if its references only reach back into output that's
+    already there, its tokens make up exactly the size in the header
+    without running out of input, and no more than max_padding bytes
+    follow it. An overlay has to end with a sensible footer and be safe to
+    decompress in place, with no compressed data left over.
+    """
+    if overlay:
+        return _scan_overlay(data)
 
-                if indicator == 0:
+    if len(data) < 4 or data[0] not in (0x10, 0x11):
+        return Report('lz??', False, "not as lzss-compressed file", 0,
+                      0, 0, 0, 0, 0)
+    lz11 = data[0] == 0x11
+    size = unpack_from("<L", data)[0] >> 8
+
+    state = [4, 0, 0]
+    try:
+        _scan_lz(data, 0, size, lz11, state)
+        error = offset = None
+    except _Failure as e:
+        error, offset = e.args
+    pos, literals, matches = state
+
+    if error is None and max_padding < len(data) - pos:
+        error = "{} bytes after the end of the stream".format(len(data) - pos)
+        offset = pos
+    return Report('lz11' if lz11 else 'lz10', error is None, error, offset,
+                  literals, matches, min(pos, len(data)), size,
+                  len(data) - pos if error is None else 0)
+
+def _scan_lz(data, start, size, lz11, state):
+    """Walks the tokens of an LZ10 or LZ11 stream whose header is at
+    data[start]. state is [position, literals, matches], kept up to date
+    for the report."""
+    end = len(data)
+    pos = start + 4
+    length = 0
+    literals = matches = 0
+    try:
+        while length < size:
+            if end <= pos:
+                raise _Failure("compressed data is truncated", pos)
+            runs = FLAG_RUNS[data[pos]]
+            pos += 1
+            last = len(runs) - 1
+            for i, run in enumerate(runs):
+                if run:
+                    n = min(run, size - length)
+                    if end < pos + n:
+                        raise _Failure("compressed data is truncated", end)
+                    pos += n
+                    length += n
+                    literals += n
+                if size <= length or i == last:
+                    break
+
+                start = pos
+                b = data[pos] if pos < end else 0
+                if not lz11:
+                    pos += 2
+                    count = (b >> 4) + 3
+                elif b >> 4 == 0:
                     # 8 bit count, 12 bit disp
-                    # indicator is 0, don't need to mask b
-                    count = (b << 4)
-                    b = readbyte()
-                    count += b >> 4
-                    count += 0x11
-                elif indicator == 1:
+                    pos += 3
+                    if pos <= end:
+                        count = (b << 4 | data[pos-2] >> 4) + 0x11
+                elif b >> 4 == 1:
                     # 16 bit count, 12 bit disp
-                    count = ((b & 0xf) << 12) + (readbyte() << 4)
-                    b = readbyte()
-                    count += b >> 4
-                    count += 0x111
+                    pos += 4
+                    if pos <= end:
+                        count = ((b & 0xf) << 12 | data[pos-3] << 4 | data[pos-2] >> 4) + 0x111
                 else:
                     # indicator is count (4 bits), 12 bit disp
-                    count = indicator
-                    count += 1
-
-                disp = ((b & 0xf) << 8) + readbyte()
-                disp += 1
+                    pos += 2
+                    count = (b >> 4) + 1
+                if end < pos:
+                    raise _Failure("compressed data is truncated", start)
+
+                disp = ((data[pos-2] & 0xf) << 8 | data[pos-1]) + 1
+                if length < disp:
+                    raise _Failure("displacement {:#x} reaches back before the start of the output".format(disp), start)
+                if size - length < count:
+                    raise _Failure("decompressed size does not match the expected size", start)
+                length += count
+                matches += 1
+    finally:
+        state[:] = pos, literals, matches
+
+def _scan_overlay(data):
+    end = len(data)
+    if end < 8:
+        return Report('overlay', False, "file is too short to be an overlay", 0,
+                      0, 0, 0, 0, 0)
+
+    end_delta, start_delta = unpack_from("<LL", data, end - 8)
+    padding = end_delta >> 0x18
+    end_delta &= 0xFFFFFF
+    size = start_delta + end_delta
+    if end < end_delta or end_delta < padding or not 8 <= padding <= 8 + 3:
+        return Report('overlay', False, "overlay header is out of range", end - 8,
+                      0, 0, 0, size, 0)
+
+    # Decompression reads down from just below the padding to stop, and
+    # writes down from stop + size. Whatever is left to write has to cover
+    # what's left to read, or the output would overwrite input it hasn't
+    # read yet.
+    stop = end - end_delta
+    pos = end - padding
+    o = size
+    literals = matches = 0
+    error = offset = None
+    try:
+        while 0 < o:
+            if pos <= stop:
+                raise _Failure("compressed data is truncated", pos)
+            pos -= 1
+            runs = FLAG_RUNS[data[pos]]
+            last = len(runs) - 1
+            for i, run in enumerate(runs):
+                if run:
+                    n = min(run, o)
+                    if pos - n < stop:
+                        raise _Failure("compressed data is truncated", stop)
+                    pos -= n
+                    o -= n
+                    literals += n
+                if o <= 0 or i == last:
+                    break
+
+                if pos - 2 < stop:
+                    raise _Failure("compressed data is truncated", pos)
+                sh = data[pos-1] << 8 | data[pos-2]
+                pos -= 2
+                count = (sh >> 0xc) + 3
+                disp = (sh & 0xfff) + 3
+                if o < count:
+                    raise _Failure("decompressed size does not match the expected size", pos)
+                if size - o < disp:
+                    raise _Failure("displacement {:#x} reaches back before the start of the output".format(disp), pos)
+                o -= count
+                matches += 1
+                if stop + o < pos:
+                    raise _Failure("decompressing in place would overwrite unread input", pos)
+
+        if stop < pos:
+            raise _Failure("{} bytes of compressed data left over".format(pos - stop), pos)
+    except _Failure as e:
+        error, offset = e.args
+
+    return Report('overlay', error is None, error, offset, literals, matches,
+                  end_delta, size, padding - 8)
+
+# A stream found by find_streams(). offset is where its header is in the
+# file, and compressed_size counts from there.
+Stream = namedtuple('Stream', 'offset format compressed_size decompressed_size')
+
+# An LZ10 or LZ11 header followed by a flag byte whose first token is a
+# literal, since there's nothing for a reference to refer to yet. The
+# lookahead lets candidates overlap.
+_candidate = re.compile(b'(?=[\x10\x11]...[\x00-\x7f])', re.DOTALL)
+
+def _find_streams(data, start, end, min_size, max_size):
+    """Checks every candidate header in data[start:end] with _scan_lz(),
+    and returns a list of Stream for the ones that pass. Streams may run
+    past end. Candidates inside a stream that's already been found are
+    skipped."""
+    streams = []
+    skip = start
+    for match in _candidate.finditer(data, start, min(end + 4, len(data))):
+        offset = match.start()
+        if offset < skip:
+            continue
+        size = unpack_from("<L", data, offset)[0] >> 8
+        if not min_size <= size <= max_size:
+            continue
 
-                yield (count, -disp), pos, flagpos
-            else:
-                raise ValueError(flag)
+        lz11 = data[offset] == 0x11
+        state = [offset + 4, 0, 0]
+        try:
+            _scan_lz(data, offset, size, lz11, state)
+        except _Failure:
+            continue
+        streams.append(Stream(offset, 'lz11' if lz11 else 'lz10',
+                              state[0] - offset, size))
+        skip = state[0]
+    return streams
+
+def _find_in_shard(path, start, end, min_size, max_size):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return _find_streams(m, start, end, min_size, max_size)
+
+def find_streams(path, jobs=None, shard_size=16 << 20, min_size=0x20,
+                 max_size=0xFFFFFF):
+    """Finds the LZ10 and LZ11 streams embedded in a file, such as a ROM
+    image or a memory dump. Returns a list of Stream, in file order.
+
+    Every header with a decompressed size between min_size and max_size is
+    checked as by scan(), except that anything may follow the stream. The
+    file is split into shards of shard_size bytes, which are searched by
+    a pool of jobs processes (by default, one per CPU).
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    shards = [(path, start, min(start + shard_size, size), min_size, max_size)
+              for start in range(0, size, shard_size)]
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(shards) <= 1:
+        results = [_find_in_shard(*shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_find_in_shard, *shard) for shard in shards]
+            results = [future.result() for future in futures]
+
+    # A stream can run on into the next shard, which doesn't know about it.
+    # Whatever that shard found inside it is dropped, but the dropped hits
+    # may have hidden real streams after it ends, so the gap up to the next
+    # hit that's kept gets searched again.
+    streams = []
+    end = 0
+    for (_, _, shard_end, _, _), result in zip(shards, results):
+        pending = list(result)
+        dropped = False
+        while pending or dropped:
+            if pending and pending[0].offset < end:
+                pending.pop(0)
+                dropped = True
+                continue
+            if dropped:
+                dropped = False
+                stop = pending[0].offset if pending else shard_end
+                found = _find_in_shard(path, end, stop, min_size, max_size)
+                if found:
+                    streams += found
+                    end = found[-1].offset + found[-1].compressed_size
+                continue
+            stream = pending.pop(0)
+            streams.append(stream)
+            end = stream.offset + stream.compressed_size
+    return streams
 
 def verify(obj):
     """Verify LZSS-compressed bytes or a file-like object.
@@ -131,56 +449,40 @@ def verify(obj):
     else:
         return verify_bytes(obj)
 
-def verify_bytes(data):
+def verify_bytes(data, overlay=False):
     """Verify LZSS-compressed bytes.
 
     Returns None on success. Raises an exception on error.
     """
-    header = data[:4]
-    if header[0] == 0x10:
-        tokenize = lz10_tokens
-    elif header[0] == 0x11:
-        tokenize = lz11_tokens
-    else:
-        raise VerificationError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+    report = scan(data, overlay)
+    if not report.ok:
+        raise VerificationError("{} at {:#x}".format(report.error, report.error_offset))
 
-    data = data[4:]
-    tokens = tokenize(data, decompressed_size)
-    return verify_tokens(tokens)
-
-def verify_file(f):
+def verify_file(f, overlay=False):
     """Verify an LZSS-compressed file.
 
     Returns None on success. Raises an exception on error.
     """
-    header = f.read(4)
-    if header[0] == 0x10:
-        tokenize = lz10_tokens
-    elif header[0] == 0x11:
-        tokenize = lz11_tokens
-    else:
-        raise VerificationError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
-
-    data = f.read()
-    tokens = tokenize(data)
-    return verify_tokens(tokens, decompressed_size)
-
-def verify_tokens(tokens, decompressed_length):
+    return verify_bytes(f.read(), overlay)
+
+def verify_tokens(tokens, positions, decompressed_length):
+    """Checks that a Tokens decompresses to exactly decompressed_length bytes
+    without reaching back before the start. positions are the offsets of
+    the tokens, for the error messages."""
+    counts = tokens.counts
+    values = tokens.values
     length = 0
-    for t in tokens:
-        t, pos, flagpos = t
-        if type(t) == tuple:
-            count, disp = t
-            assert disp < 0
-            assert 0 < count
-            if disp + length < 0:
+    for k in range(len(counts)):
+        count = counts[k]
+        if count:
+            disp = values[k]
+            assert 0 < disp
+            if length < disp:
+                pos = positions[k]
+                flagpos = positions[k - k % 8] - 1
                 raise VerificationError(
                     "disp too large. length: {:#x}, disp: {:#x}, pos: {:#x}, flagpos: {:#x}"
-                    .format(length, disp, pos, flagpos))
+                    .format(length, -disp, pos, flagpos))
             length += count
         else:
             length += 1
@@ -205,29 +507,70 @@ def dump_file(f):
     decompressed_size, = unpack("<L", header[1:] + b'\x00')
 
     data = f.read()
-    tokens = tokenize(data)
-    def dump():
-        for t, pos, flagpos in tokens:
-            if type(t) == tuple:
-                yield t
+    tokens, positions = tokenize(data, decompressed_size)
     from pprint import pprint
-    pprint(list(dump()))
+    pprint([t for t in tokens if type(t) == tuple])
+
+def find_main(args):
+    """The command line for find_streams()."""
+    usage = "usage: verify.py --find [-j JOBS] [--min-size BYTES] FILE"
+    path = None
+    kwargs = {}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--find':
+            continue
+        elif arg in ('-j', '--jobs', '--min-size') and args:
+            try:
+                value = int(args.pop(0), 0)
+            except ValueError:
+                print(usage, file=stderr)
+                return 2
+            kwargs['min_size' if arg == '--min-size' else 'jobs'] = value
+        elif path is None:
+            path = arg
+        else:
+            print(usage, file=stderr)
+            return 2
+
+    if path is None:
+        print(usage, file=stderr)
+        return 2
+
+    start = time.perf_counter()
+    try:
+        streams = find_streams(path, **kwargs)
+    except IOError as e:
+        print(e, file=stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    for stream in streams:
+        print("{:#010x} {} {:#x} {:#x}".format(*stream))
+    print("{} streams in {:.2f}s".format(len(streams), elapsed), file=stderr)
+    return 0
 
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
+    if '--find' in args:
+        return find_main(args)
+
     if '--overlay' in args:
         args.remove('--overlay')
         overlay = True
     else:
         overlay = False
 
-    if len(args) < 1 or args[0] == '-':
-        if overlay:
-            print("Can't verify overlays from stdin", file=stderr)
-            return 2
+    if '--dump' in args:
+        args.remove('--dump')
+        dump = True
+    else:
+        dump = False
 
+    if len(args) < 1 or args[0] == '-':
         if hasattr(stdin, 'detach'):
             f = stdin.detach()
         else:
@@ -239,19 +582,26 @@ def main(args=None):
             print(e, file=stderr)
             return 2
 
-    try:
+    if dump:
         if overlay:
-            print("Can't verify overlays", file=stderr)
-        else:
-            #verify_file(f)
+            print("Can't dump overlays", file=stderr)
+            return 2
+        try:
             dump_file(f)
-    except (VerificationError,) as e:
-        print(e, file=stderr)
+        except (VerificationError,) as e:
+            print(e, file=stderr)
+            return 1
+        return 0
+
+    report = scan(f.read(), overlay)
+    print("{}: {} literals, {} matches, {:#x} bytes -> {:#x} bytes, {} bytes of padding".format(
+        report.format, report.literals, report.matches,
+        report.compressed_size, report.decompressed_size, report.padding))
+    if not report.ok:
+        print("{} at {:#x}".format(report.error, report.error_offset), file=stderr)
         return 1
 
     return 0
 
-
-
 if __name__ == '__main__':
     exit(main())